@@ -10,34 +10,224 @@ import luigi
 import json
 import xml.etree.ElementTree as ET
 import utils
-import time
-import math
+import collections
+import functools
+import hashlib
+import datetime
 import csv
-import io
 import os
 import zipfile
+import shutil
+import tempfile
+import atexit
+import logging
 import rasterio
 import pickle
 import pandas as pd
 import numpy as np
 from zipfile import ZipFile
 from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from urllib3.util.retry import Retry
 from luigi.parameter import ParameterVisibility
 
-class EntrezTask(luigi.Task):
-    url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
-    retries = Retry(backoff_factor=0.1)
-    adapter = requests.adapters.HTTPAdapter(max_retries=retries)
+logger = logging.getLogger('luigi-interface')
+
+class HTTPCache(luigi.Config):
+
+    # This configuration sets up a local cache of the responses from the NCBI
+    # and GBIF APIs. With mode 'record', every response is stored. With
+    # 'replay', stored responses are served without going to the network, or
+    # revalidated with a conditional request if --HTTPCache-revalidate is
+    # set, and misses are recorded. With 'offline', only stored responses are
+    # served. Occurrence archive downloads are never cached, and download
+    # status requests always go to the network unless offline.
+
+    mode = luigi.ChoiceParameter(choices=['off', 'record', 'replay', 'offline'],
+        default='off')
+    path = luigi.Parameter(default='data/http-cache.sqlite')
+    revalidate = luigi.BoolParameter(default=False)
+
+    def adapter(self, retries):
+        if self.mode == 'off':
+            return requests.adapters.HTTPAdapter(max_retries=retries)
+        store = utils.ResponseStore(self.path)
+        return utils.CachingAdapter(store, self.mode, self.revalidate,
+            max_retries=retries)
+
+
+class Endpoints(luigi.Config):
+
+    # This configuration sets the base URLs of the NCBI E-utilities and the
+    # GBIF API, so that the pipeline can be pointed at a mirror or at the
+    # local stand-ins of benchmark.py.
+    entrez = luigi.Parameter(default=utils.EUTILS_URL)
+    gbif = luigi.Parameter(default=utils.GBIF_URL)
+
+
+class Telemetry(luigi.Config):
+
+    # This configuration sets where the performance of each stage is reported.
+    # Every task records its metrics in 'stage_dir' when it finishes, and the
+    # JSON run report and the Prometheus textfile, for the node exporter's
+    # textfile collector, are rebuilt from the latest record of every stage
+    # once, when the run ends. Progress messages are shown at most once every
+    # 'progress_interval' seconds.
+    stage_dir = luigi.Parameter(default='data/telemetry')
+    report = luigi.Parameter(default='data/run-report.json')
+    textfile = luigi.Parameter(default='data/basil.prom')
+    progress_interval = luigi.FloatParameter(default=5.0)
+
+    def record(self, task, status):
+        os.makedirs(self.stage_dir, exist_ok=True)
+        stage = task.metrics.summary()
+        stage.update({'task': task.get_task_family(),
+                      'task_id': task.task_id,
+                      'status': status})
+        path = os.path.join(self.stage_dir, task.task_id + '.json')
+        with luigi.LocalTarget(path).open('w') as f:
+            json.dump(stage, f)
+
+    def write_report(self):
+        # Builds the report and the textfile, unless no stage has been
+        # recorded since they were last written.
+        if not os.path.isdir(self.stage_dir):
+            return
+        # Other workers may be writing stages under temporary names.
+        paths = [os.path.join(self.stage_dir, name) for name
+                 in sorted(os.listdir(self.stage_dir))
+                 if name.endswith('.json')]
+        if not paths:
+            return
+        if (os.path.exists(self.report) and max(map(os.path.getmtime, paths))
+                < os.path.getmtime(self.report)):
+            return
+        stages = []
+        for path in paths:
+            with open(path, 'r') as f:
+                stages.append(json.load(f))
+        stages.sort(key=lambda stage: stage['started'])
+        with luigi.LocalTarget(self.report).open('w') as f:
+            json.dump({'stages': stages}, f, indent=2)
+        with luigi.LocalTarget(self.textfile).open('w') as f:
+            f.write(utils.prometheus_text(stages))
+
+
+@luigi.Task.event_handler(luigi.Event.START)
+def start_stage(task):
+    # Attaches metrics and a throttled progress reporter to every task.
+    task.metrics = utils.StageMetrics()
+    def report(message):
+        task.set_status_message(message)
+        logger.info(message)
+    task.progress = utils.Progress(report, Telemetry().progress_interval)
+
+@luigi.Task.event_handler(luigi.Event.SUCCESS)
+def record_success(task):
+    Telemetry().record(task, 'SUCCESS')
+
+@luigi.Task.event_handler(luigi.Event.FAILURE)
+def record_failure(task, exception):
+    if hasattr(task, 'metrics'):
+        Telemetry().record(task, 'FAILURE')
+
+@atexit.register
+def write_run_report():
+    # Worker processes leave without running exit handlers, so the report is
+    # written once, by the process that scheduled the run.
+    Telemetry().write_report()
+
+
+class APITask(luigi.Task):
+
+    # This base class mounts the retry configuration of a task, wrapped by the
+    # HTTP cache if it is enabled, on a session, and records the requests
+    # sent by the session in the metrics of the task.
+
+    def mount(self, session):
+        session.mount(self.url, HTTPCache().adapter(self.retries))
+        self.instrument(session)
+
+    def instrument(self, session):
+        session.hooks['response'].append(self.metrics.observe_response)
+
+    def journal(self, context):
+        # Opens the checkpoint journal in which this task records the batches
+        # of work it has completed. It is discarded once the output has been
+        # written, so it is only ever read by a restarted task.
+        path = os.path.join('data', 'journals', self.task_id + '.jsonl')
+        return utils.Journal(path, context)
+
+
+class EntrezTask(APITask):
+    # Requests refused for going over the rate limit are retried after the
+    # delay NCBI asks for.
+    retries = Retry(backoff_factor=0.1, status_forcelist=[429, 502, 503],
+        method_whitelist=['GET', 'POST'], respect_retry_after_header=True)
     timeout = 30
-    retmax = 50 # Limit of 500 for JSON response.
+    # Number of records per ESummary or ELink request. ESummary returns at
+    # most 500 records per JSON response and 10,000 per XML response.
+    retmax = luigi.IntParameter(default=50)
+    # With --retmode xml, ESummary responses are parsed incrementally as they
+    # stream in, keeping only the fields that are needed.
+    retmode = luigi.ChoiceParameter(choices=['json', 'xml'], default='json')
     db = luigi.Parameter(default='protein')
     api_key = luigi.Parameter(default='beac95a908b21daf251667ee6eb138a05608',
         visibility=ParameterVisibility.PRIVATE)
+    # Number of ESummary requests kept in flight at once.
+    max_concurrent_requests = luigi.IntParameter(default=4)
+    uilist_max = 10000 # Limit of 10,000 UIDs per EFetch request.
+
+    @property
+    def url(self):
+        return Endpoints().entrez
+
+    def send_pages(self, session, prep, count, retmax, parse, journal, stage):
+        # Sends a request for each page of 'retmax' records, with several in
+        # flight at once, and yields the parsed pages in order. NCBI allows
+        # 10 requests per second with an API key and 3 per second without one.
+        # Each page is recorded in the journal under 'stage', and pages that
+        # an earlier attempt recorded are taken from it instead of requested.
+        # A page that still fails after the retries fails the task, rather
+        # than leaving its records out.
+        rate = 10 if self.api_key else 3
+        limiter = utils.TokenBucket(rate, metrics=self.metrics)
+        retstarts = range(0, count, retmax)
+        done = {record['retstart']: record['page'] for record
+                in journal.records if record['stage'] == stage}
+        prepped_requests = (prep(retstart) for retstart in retstarts
+                            if retstart not in done)
+        pages = utils.send_concurrently(session, prepped_requests, limiter,
+            self.max_concurrent_requests, self.timeout, parse)
+        for retstart in retstarts:
+            self.progress.update('Progress: {0:.0%}', retstart / count)
+            if retstart in done:
+                yield done[retstart]
+                continue
+            page = next(pages)
+            if page is None:
+                raise Exception('The {} request at retstart {} failed.'.format(
+                    stage, retstart))
+            journal.append({'stage': stage, 'retstart': retstart,
+                            'page': page})
+            yield page
+
+    def get_summaries(self, session, query_key, webenv, count, db, fields,
+                      journal):
+        # Pages through the History Server with the ESummary utility and
+        # yields a list of the UID and 'fields' of each summary per page.
+        if self.retmode == 'json' and self.retmax > 500:
+            raise Exception('ESummary returns at most 500 records per JSON '
+                            'response; use --retmode xml.')
+        prep = functools.partial(utils.prep_esummary_req, query_key, webenv,
+            retmax=self.retmax, db=db, api_key=self.api_key,
+            retmode=self.retmode, base_url=self.url)
+        parse = functools.partial(utils.parse_esummary, fields=fields)
+        yield from self.send_pages(session, prep, count, self.retmax, parse,
+            journal, 'esummary')
 
     
-class GBIFTask(luigi.Task):
-    url = 'http://api.gbif.org/v1/'
+class GBIFTask(APITask):
     retries = Retry(backoff_factor=0.1)
     adapter = requests.adapters.HTTPAdapter(max_retries=retries)
     timeout = 30
@@ -45,16 +235,138 @@ class GBIFTask(luigi.Task):
     pwd = luigi.Parameter(default='f5Rga5RPGgg4GNEa',
         visibility=ParameterVisibility.PRIVATE)
 
+    @property
+    def url(self):
+        return Endpoints().gbif
+
 
-class SearchDB(EntrezTask):
+class QueryTask(luigi.Task):
+
+    # This base class gives a task the search term of the query it belongs to
+    # and a directory of its own under 'data/queries', named after the term,
+    # so that the pipelines of several queries can run side by side without
+    # overwriting each other. Tasks that do not depend on the query, such as
+    # those that prepare the raster data or handle a single download ID,
+    # write to 'data' and are shared by all queries.
+
+    search_term = luigi.Parameter(default='plants[Filter] AND nbs lrr[Title]')
+
+    @property
+    def query_dir(self):
+        return os.path.join('data', 'queries',
+                            utils.query_namespace(self.search_term))
+
+    def query_target(self, name, **kwargs):
+        return luigi.LocalTarget(os.path.join(self.query_dir, name), **kwargs)
+
+    def for_query(self, task_class, **kwargs):
+        # Returns the task of 'task_class' that belongs to the same query.
+        return task_class(search_term=self.search_term, **kwargs)
+
+
+class Intermediates(luigi.Config):
+
+    # This configuration sets the file format of the tables passed between the
+    # occurrence stages. Parquet tables have typed columns (int64 species keys
+    # and float32 coordinates and bioclimatic variables) and require pyarrow.
+
+    file_format = luigi.ChoiceParameter(choices=['csv', 'parquet'],
+        default='csv')
+
+    @property
+    def parquet(self):
+        return self.file_format == 'parquet'
+
+    def target(self, name, directory='data'):
+        path = os.path.join(directory, name)
+        if self.parquet:
+            utils.require_pyarrow()
+            return luigi.LocalTarget(path + '.parquet', format=luigi.format.Nop)
+        return luigi.LocalTarget(path + '.txt')
+
+
+class Incremental(luigi.Config):
+
+    # This configuration turns on incremental runs. The results of each run
+    # of a query are recorded in 'baseline_dir', which is relative to the
+    # directory of the query, by RecordRunManifest. With
+    # --Incremental-enabled, taxa and species keys covered by that baseline
+    # are not resolved or downloaded again, and the new climate aggregates
+    # are merged into the previous ones.
+
+    enabled = luigi.BoolParameter(default=False)
+    baseline_dir = luigi.Parameter(default='baseline')
+
+    def directory(self, task):
+        return os.path.join(task.query_dir, self.baseline_dir)
+
+    def manifest_path(self, task):
+        return os.path.join(self.directory(task), 'manifest.json')
+
+    def load_manifest(self, task):
+        # Returns the manifest of the previous run of the query of 'task', or
+        # None if incremental runs are disabled or there is no previous run.
+        path = self.manifest_path(task)
+        if not self.enabled or not os.path.exists(path):
+            return None
+        with open(path, 'r') as manifest:
+            return json.load(manifest)
+
+    def baseline_file(self, task, manifest, name):
+        return os.path.join(self.directory(task), manifest['files'][name])
+
+
+class SpeciesStore(luigi.Config):
+
+    # This configuration turns on the store of species artifacts shared by
+    # all queries, kept in a SQLite database at 'path'. With
+    # --SpeciesStore-enabled, the climate aggregates of every query are added
+    # to the store under a profile of the settings they depend on, and
+    # species keys that already have aggregates under the same profile are
+    # neither downloaded nor sampled again. Archives kept with
+    # --DownloadOccurrences-keep-archives are added as well, and species keys
+    # found in one are sampled from it instead of being downloaded again,
+    # except with --ConsolidateAndFilterOccurrences-fan-out. Name matches are
+    # already shared through the match cache of GBIFSpeciesMatch.
+
+    enabled = luigi.BoolParameter(default=False)
+    path = luigi.Parameter(default='data/species-store.sqlite')
+
+    def open(self):
+        return utils.ArtifactStore(self.path)
+
+    def profile(self, task):
+        # Returns a digest of the raster files and of the settings of the
+        # query of 'task' that change its climate aggregates.
+        sample = task.for_query(SampleRasterData)
+        consolidate = sample.requires()[0]
+        rasters = [(os.path.basename(path), os.path.getsize(path))
+                   for path in utils.list_raster_files('raster')]
+        settings = {'rasters': rasters,
+                    'coord_uncertainty_limit':
+                        consolidate.coord_uncertainty_limit,
+                    'dedupe': consolidate.dedupe,
+                    'dedupe_digits': consolidate.dedupe_digits,
+                    'thin': sample.thin,
+                    'buffered': sample.buffered,
+                    'scaled': sample.cube and BuildClimateCube().scaled,
+                    'file_format': Intermediates().file_format
+                    }
+        text = json.dumps(settings, sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+    def reuse_archives(self, task):
+        consolidate = task.for_query(ConsolidateAndFilterOccurrences)
+        return self.enabled and not consolidate.fan_out
+
+
+class SearchDB(QueryTask, EntrezTask):
     
     # This task searches an NCBI database and, using the Entrez History Server
 	# and ESearch utility, returns a web environment and query key.
     
-    search_term = luigi.Parameter(default='plants[Filter] AND nbs lrr[Title]')
-    
     def output(self):
-        return luigi.LocalTarget('data/{}-esearch-params.json'.format(self.db))
+        return self.query_target('{}-esearch-params.json'.format(self.db))
 
     def run(self):
         with ExitStack() as stack:
@@ -65,62 +377,83 @@ class SearchDB(EntrezTask):
                        'usehistory':'y',
                        'term':self.search_term
                        }
-            s.mount(self.url, self.adapter)
+            self.mount(s)
             r = s.get(self.url + 'esearch.fcgi', params=payload,
                 timeout=self.timeout)
             if r.status_code == requests.codes.ok:
                 outfile.write(r.text)
         
 
-class GetDocSummaries(EntrezTask):
+class GetDocSummaries(QueryTask, EntrezTask):
     
     # This task returns a list of UIDs and Taxonomy IDs corresponding to the
     # previous web environment and query key using the ESummary utility.
+
+    # With --taxid-source elink, the UIDs are listed with EFetch and linked to
+    # their Taxonomy IDs with ELink, which returns far less than a full
+    # document summary per UID.
+    taxid_source = luigi.ChoiceParameter(choices=['esummary', 'elink'],
+        default='esummary')
     
     def requires(self):
-        return SearchDB()
+        return self.for_query(SearchDB)
         
     def output(self):
-        return luigi.LocalTarget('data/{}-docsummaries.txt'.format(self.db))
+        return self.query_target('{}-docsummaries.txt'.format(self.db))
         
     def run(self):
         with ExitStack() as stack:
             infile = stack.enter_context(self.input().open('r'))
             outfile = stack.enter_context(self.output().open('w'))
             s = stack.enter_context(requests.Session())
-            s.mount(self.url, self.adapter)            
+            self.mount(s)
             result = json.load(infile)['esearchresult']
             query_key = result['querykey']
             webenv = result['webenv']
             count = int(result['count'])        
-            for retstart in range(0, count, self.retmax):
-                time.sleep(0.1) # 10 requests per second limit.
-                message = 'Progress: {0:.0%}'.format(retstart / count)
-                self.set_status_message(message)
-                print(message)
-                args = [query_key, webenv, retstart,
-                        self.retmax, self.db, self.api_key]
-                prepped = utils.prep_esummary_req(*args)
-                r = s.send(prepped, timeout=self.timeout, stream=False)
-                if r.status_code == requests.codes.ok:
-                    for key, value in r.json()['result'].items():
-                        # Skips list of UIDs included in result.
-                        if key != 'uids':
-                            data = {'uid':value['uid'],
-                                    'taxid':value['taxid']
-                                    }
-                            outfile.write('{uid},{taxid}\n'.format(**data))
+            journal = stack.enter_context(self.journal({'webenv':webenv}))
+            if self.taxid_source == 'elink':
+                for links in self.get_links(s, query_key, webenv, count,
+                                            journal):
+                    self.metrics.add('rows_out', len(links))
+                    for uid, taxid in links:
+                        outfile.write('{},{}\n'.format(uid, taxid))
+            else:
+                args = [s, query_key, webenv, count, self.db, ['taxid'],
+                        journal]
+                for summaries in self.get_summaries(*args):
+                    self.metrics.add('rows_out', len(summaries))
+                    for data in summaries:
+                        outfile.write('{uid},{taxid}\n'.format(**data))
+        journal.discard()
+
+    def get_links(self, session, query_key, webenv, count, journal):
+        # Lists the UIDs on the History Server and yields their links to the
+        # Taxonomy database, a batch of 'retmax' UIDs at a time.
+        prep = functools.partial(utils.prep_uilist_req, query_key, webenv,
+            retmax=self.uilist_max, db=self.db, api_key=self.api_key,
+            base_url=self.url)
+        uids = []
+        for page in self.send_pages(session, prep, count, self.uilist_max,
+                                    utils.parse_uilist, journal, 'uilist'):
+            uids.extend(page)
+        def prep(retstart):
+            batch = uids[retstart:retstart + self.retmax]
+            return utils.prep_elink_req(batch, self.db, 'taxonomy',
+                self.api_key, self.url)
+        yield from self.send_pages(session, prep, len(uids), self.retmax,
+                                   utils.parse_elink, journal, 'elink')
                                 
 
-class RemoveDuplicateTaxIDs(luigi.Task):
+class RemoveDuplicateTaxIDs(QueryTask):
     
     # This task returns a list of unique Taxonomy IDs.
     
     def requires(self):
-        return GetDocSummaries()
+        return self.for_query(GetDocSummaries)
         
     def output(self):
-        return luigi.LocalTarget('data/unique-taxids.txt')
+        return self.query_target('unique-taxids.txt')
         
     def run(self):
         with ExitStack() as stack:
@@ -132,18 +465,18 @@ class RemoveDuplicateTaxIDs(luigi.Task):
                 outfile.write(taxid + '\n')
                 
                                 
-class PostTaxIDs(EntrezTask):
+class PostTaxIDs(QueryTask, EntrezTask):
     
     # This task posts the previous list of unique Taxonomy IDs to the NCBI
     # Taxonomy database and, using the Entrez History Server and EPost
     # utility, returns a web environment and query key.
 
     def requires(self):
-        return RemoveDuplicateTaxIDs()
+        return self.for_query(RemoveDuplicateTaxIDs)
         
     def output(self):
         # Entrez EPost does not support JSON formatted output.
-        return luigi.LocalTarget('data/taxonomy-epost-params.xml')
+        return self.query_target('taxonomy-epost-params.xml')
         
     def run(self):
         with ExitStack() as stack:
@@ -152,75 +485,103 @@ class PostTaxIDs(EntrezTask):
             s = stack.enter_context(requests.Session())
             taxids = ','.join(infile.read().splitlines())
             payload = {'db':'taxonomy', 'id':taxids}
-            s.mount(self.url, self.adapter)        
+            self.mount(s)
             r = s.post(self.url + 'epost.fcgi', data=payload,
                 timeout=self.timeout)
             if r.status_code == requests.codes.ok:
                 outfile.write(r.text)
                     
             
-class GetTaxonomySummaries(EntrezTask):
+class GetTaxonomySummaries(QueryTask, EntrezTask):
     
     # This task returns a list of Taxonomy IDs and scientific names
     # corresponding to the previous web environment and query key using the
     # ESummary utility. 
     
     def requires(self):
-        return [PostTaxIDs(), RemoveDuplicateTaxIDs()]
+        return [self.for_query(PostTaxIDs),
+                self.for_query(RemoveDuplicateTaxIDs)]
         
     def output(self):
-        return luigi.LocalTarget('data/taxonomy-docsummaries.txt')
+        return self.query_target('taxonomy-docsummaries.txt')
         
     def run(self):
         with ExitStack() as stack:
             infiles = [stack.enter_context(f.open('r')) for f in self.input()]
             outfile = stack.enter_context(self.output().open('w'))
             s = stack.enter_context(requests.Session())
-            s.mount(self.url, self.adapter)
+            self.mount(s)
             # Using ElementTree to parse XML response content.
-			tree = ET.parse(infiles[0])
+            tree = ET.parse(infiles[0])
             root = tree.getroot()
             query_key = root[0].text
             webenv = root[1].text
             count = len(infiles[1].read().splitlines())
-            for retstart in range(0, count, self.retmax):
-                time.sleep(0.1) # 10 requests per second limit.
-                message = 'Progress: {0:.0%}'.format(retstart / count)
-                self.set_status_message(message)
-                print(message)
-                args = [query_key, webenv, retstart,
-                    self.retmax, 'taxonomy', self.api_key]
-                prepped = utils.prep_esummary_req(*args)
-                r = s.send(prepped, timeout=self.timeout, stream=False)
-                if r.status_code == requests.codes.ok:
-                    for key, value in r.json()['result'].items():
-                        # Skips list of UIDs included in result.
-                        if key != 'uids':
-                            data = {'taxid':value['taxid'],
-                                    'sname':value['scientificname']
-                                    }                        
-                            outfile.write('{taxid},{sname}\n'.format(**data))
+            journal = stack.enter_context(self.journal({'webenv':webenv}))
+            args = [s, query_key, webenv, count, 'taxonomy',
+                    ['taxid', 'scientificname'], journal]
+            for summaries in self.get_summaries(*args):
+                self.metrics.add('rows_out', len(summaries))
+                for data in summaries:
+                    outfile.write('{taxid},{scientificname}\n'.format(
+                        **data))
+        journal.discard()
                                     
 
-class GBIFSpeciesMatch(GBIFTask):
+class GBIFSpeciesMatch(QueryTask, GBIFTask):
 
     # This task uses the GBIF Species API to map the previous list of scientific
     # names from the NCBI Taxonomy Database to a list of GBIF species keys.
     
+    # Matches are cached on disk between runs. The cache can be cleared with
+    # --invalidate-match-cache.
+    match_cache = luigi.Parameter(default='data/gbif-name-matches.sqlite')
+    match_cache_ttl = luigi.TimeDeltaParameter(
+        default=datetime.timedelta(days=30))
+    invalidate_match_cache = luigi.BoolParameter(default=False)
+    # Number of species/match requests kept in flight for cache misses.
+    max_concurrent_requests = luigi.IntParameter(default=8)
+    # With --backbone set to a GBIF Backbone Taxonomy dump (backbone.zip or
+    # Taxon.tsv), names are matched against it in memory instead of the
+    # remote service, and the match cache is not used.
+    backbone = luigi.Parameter(default='')
+    kingdom = 'plantae'
+    strict = 'true'
+
     def requires(self):
-        return GetTaxonomySummaries()
+        return self.for_query(GetTaxonomySummaries)
         
     def output(self):
-        return luigi.LocalTarget('data/gbif-species-matches.txt')
+        return self.query_target('gbif-species-matches.txt')
         
     def run(self):
         with ExitStack() as stack:
             infile = stack.enter_context(self.input().open('r'))
             outfile = stack.enter_context(self.output().open('w'))
             s = stack.enter_context(requests.Session())
-            s.mount(self.url, self.adapter)
+            self.mount(s)
+            ttl = self.match_cache_ttl.total_seconds()
+            cache = utils.NameMatchCache(self.match_cache, ttl)
+            stack.enter_context(cache)
+            if self.invalidate_match_cache:
+                cache.invalidate()
             entrez_data = [line.split(',', maxsplit=1) for line 
                            in infile.read().splitlines()]
+            manifest = Incremental().load_manifest(self)
+            if manifest:
+                # Taxa resolved by the previous run are copied from its
+                # matches and only new taxa are looked up.
+                previous = set(manifest['taxids'])
+                current = set(taxid for taxid, sname in entrez_data)
+                path = Incremental().baseline_file(self, manifest, 'matches')
+                with open(path, 'r') as baseline:
+                    for line in baseline.read().splitlines():
+                        if line.split(',', maxsplit=1)[0] in current:
+                            outfile.write(line + '\n')
+                entrez_data = [(taxid, sname) for taxid, sname in entrez_data
+                               if taxid not in previous]
+                print('{} of {} taxa are new since the previous run'.format(
+                    len(entrez_data), len(current)))
             ranks = ['SPECIES',
                     'SUBSPECIES',
                     'VARIETY',
@@ -230,37 +591,63 @@ class GBIFSpeciesMatch(GBIFTask):
                     'CULTIVAR_GROUP',
                     'CULTIVAR'
                     ]
-            for i, line in enumerate(entrez_data):
-                taxid, sname = line
-                message = 'Progress: {0:.0%}'.format(i / len(entrez_data))
-                self.set_status_message(message)
-                if i % 10 == 0: print(message)
-                payload = {'name': sname, 'kingdom':'plantae', 'strict':'true'}
-                r = s.get(self.url + 'species/match', params=payload,
-                          stream=False, timeout=self.timeout)
+            # Names matched remotely by an interrupted attempt are taken from
+            # its journal, even if the match cache has since been invalidated.
+            context = {'kingdom':self.kingdom, 'strict':self.strict}
+            journal = stack.enter_context(self.journal(context))
+            results = {record['name']: record['result']
+                       for record in journal.records}
+            if self.backbone:
+                index = utils.BackboneIndex(self.backbone, self.kingdom)
+                for taxid, sname in entrez_data:
+                    results[sname] = index.match(sname)
+            else:
+                for taxid, sname in entrez_data:
+                    if sname in results:
+                        continue
+                    result = cache.get(sname, self.kingdom, self.strict)
+                    if result is not None:
+                        results[sname] = result
+            self.metrics.add('rows_in', len(entrez_data))
+            misses = [sname for taxid, sname in entrez_data
+                      if sname not in results]
+            prepped_requests = (utils.prep_species_match_req(sname,
+                self.kingdom, self.strict, self.url) for sname in misses)
+            responses = utils.send_concurrently(s, prepped_requests, None,
+                self.max_concurrent_requests, self.timeout)
+            for i, (sname, r) in enumerate(zip(misses, responses)):
+                self.progress.update('Progress: {0:.0%}', i / len(misses))
                 if r.status_code == requests.codes.ok:
                     result = r.json()
-                    if result['matchType'] != 'NONE' and result['rank'] in ranks:
-                        data = [taxid,
-                                result['speciesKey'],
-                                result['phylum'],
-                                result['order'],
-                                result['family'],
-                                result['genus'],
-                                result['species']
-                                ]
-                        outfile.write(','.join([str(i) for i in data]) + '\n')
+                    cache.put(sname, self.kingdom, self.strict, result)
+                    journal.append({'name':sname, 'result':result})
+                    results[sname] = result
+            for taxid, sname in entrez_data:
+                result = results.get(sname)
+                if (result and result['matchType'] != 'NONE'
+                    and result['rank'] in ranks):
+                    data = [taxid,
+                            result['speciesKey'],
+                            result['phylum'],
+                            result['order'],
+                            result['family'],
+                            result['genus'],
+                            result['species']
+                            ]
+                    outfile.write(','.join([str(i) for i in data]) + '\n')
+                    self.metrics.add('rows_out')
+        journal.discard()
                                     
                         
-class RemoveDuplicateSpeciesKeys(luigi.Task):
+class RemoveDuplicateSpeciesKeys(QueryTask):
 
     # This task returns a list of unique species keys.
 
     def requires(self):
-        return GBIFSpeciesMatch()
+        return self.for_query(GBIFSpeciesMatch)
         
     def output(self):
-        return luigi.LocalTarget('data/unique-species-keys.txt')
+        return self.query_target('unique-species-keys.txt')
         
     def run(self):
         with ExitStack() as stack:
@@ -272,22 +659,72 @@ class RemoveDuplicateSpeciesKeys(luigi.Task):
                 outfile.write(species_key + '\n')
                 
                 
-class PostUsageKeys(GBIFTask):
+class NewSpeciesKeys(QueryTask):
+
+    # This task returns the unique species keys that the previous run did not
+    # request occurrences for, leaving out those that the species store
+    # covers if it is enabled. Without a previous run or a store, all keys are
+    # returned.
+
+    def requires(self):
+        return self.for_query(RemoveDuplicateSpeciesKeys)
+
+    def output(self):
+        return self.query_target('new-species-keys.txt')
+
+    def run(self):
+        with ExitStack() as stack:
+            infile = stack.enter_context(self.input().open('r'))
+            outfile = stack.enter_context(self.output().open('w'))
+            manifest = Incremental().load_manifest(self)
+            previous = set(manifest['species_keys']) if manifest else set()
+            species_keys = infile.read().splitlines()
+            species_store = SpeciesStore()
+            if species_store.enabled:
+                with species_store.open() as store:
+                    previous.update(store.aggregated_keys(
+                        species_store.profile(self), species_keys))
+                    if species_store.reuse_archives(self):
+                        previous.update(store.archives(species_keys))
+            new = [species_key for species_key in species_keys
+                   if species_key not in previous]
+            for species_key in new:
+                outfile.write(species_key + '\n')
+            print('{} of {} species keys are new'.format(len(new),
+                                                         len(species_keys)))
+
+
+class PostUsageKeys(QueryTask, GBIFTask):
 
     # This task posts the previous list of unique species keys to the GBIF
-    # Occurrence Store in chunk sizes of no larger than 300 and returns a list
-    # of download IDs.
+    # Occurrence Store in as few requests as the predicate size limit allows
+    # and returns a list of download IDs. GBIF limits the number of downloads
+    # a user may have in preparation at once, so a new request is only posted
+    # once fewer than 'max_concurrent_downloads' of the account's downloads,
+    # including those of other queries, are being prepared.
 
-    chunk_size = 75 # Must be no greater than 300 per GBIF limits.
+    # Must be no greater than 300 per GBIF limits.
+    max_keys_per_request = luigi.IntParameter(default=300)
+    max_concurrent_downloads = luigi.IntParameter(default=3)
+    poll_interval = 15
+    poll_deadline = luigi.TimeDeltaParameter(
+        default=datetime.timedelta(hours=24))
+    # Throttling is avoided by the scheduler, so only a few retries are made.
     retries = Retry(backoff_factor=4, status_forcelist=[503, 420], total=None,
-        connect=10, read=10, redirect=10, status=250, method_whitelist=['POST'])
-    adapter = requests.adapters.HTTPAdapter(max_retries=retries)
+        connect=10, read=10, redirect=10, status=5, method_whitelist=['POST'])
 
     def requires(self):
-        return RemoveDuplicateSpeciesKeys()
+        if Incremental().enabled or SpeciesStore().enabled:
+            return self.for_query(NewSpeciesKeys)
+        return self.for_query(RemoveDuplicateSpeciesKeys)
     
     def output(self):
-        return luigi.LocalTarget('data/download-IDs.txt')
+        return self.query_target('download-IDs.txt')
+
+    def requested_keys(self):
+        # The species keys requested by each download ID are listed alongside
+        # the IDs, so that the archives can be added to the species store.
+        return self.query_target('download-species-keys.json')
     
     def run(self):
         with ExitStack() as stack:
@@ -295,37 +732,52 @@ class PostUsageKeys(GBIFTask):
             outfile = stack.enter_context(self.output().open('w'))
             s = stack.enter_context(requests.Session())    
             species_keys = infile.read().splitlines()
-            length = len(species_keys)
-            number_of_chunks = math.ceil(length / self.chunk_size)
-            s.mount(self.url, self.adapter)
+            if not 0 < self.max_keys_per_request <= 300:
+                raise Exception('max_keys_per_request must be between 1 and '
+                                '300, the most species keys GBIF accepts in '
+                                'a download request.')
+            chunks = utils.pack_species_keys(species_keys,
+                self.max_keys_per_request)
+            self.mount(s)
             s.auth = (self.user, self.pwd)
-            for i, start in enumerate(range(0, length, self.chunk_size)):
-                message = 'Progress: {0:.0%}'.format(i / number_of_chunks)
-                self.set_status_message(message)
-                print(message)
-                end = start + self.chunk_size
-                if end < length:
-                    chunk = species_keys[start:end]
-                else:
-                    chunk = species_keys[start:]
+            url = self.url + 'occurrence/download/'
+            # Chunks posted by an interrupted attempt are not posted again.
+            journal = stack.enter_context(self.journal({'chunks':chunks}))
+            posted = {record['chunk']: record['download_id']
+                      for record in journal.records}
+            for i, chunk in enumerate(chunks):
+                self.progress.update('Progress: {0:.0%}', i / len(chunks))
+                if i in posted:
+                    continue
+                args = [s, url, self.user, self.max_concurrent_downloads,
+                        self.timeout, self.poll_interval,
+                        self.poll_deadline.total_seconds(), self.metrics]
+                utils.wait_for_download_slot(*args)
                 payload = utils.generate_query_expression(chunk)
                 r = s.post(self.url + 'occurrence/download/request',
                             json=payload, timeout=self.timeout)
                 if r.status_code == 201:
                     download_id = r.text
-                    outfile.write(download_id + '\n')
+                    journal.append({'chunk':i, 'download_id':download_id})
+                    posted[i] = download_id
+            for i in sorted(posted):
+                outfile.write(posted[i] + '\n')
+            with self.requested_keys().open('w') as keys_file:
+                json.dump({posted[i]: chunks[i] for i in sorted(posted)},
+                          keys_file)
+        journal.discard()
                         
                 
-class GetDOIs(GBIFTask):
+class GetDOIs(QueryTask, GBIFTask):
 
     # This task returns a list of Digital Object Identifiers (DOIs)
     # corresponding to the previous list of download IDs.
 
     def requires(self):
-        return PostUsageKeys()
+        return self.for_query(PostUsageKeys)
     
     def output(self):
-        return luigi.LocalTarget('data/DOIs.txt')
+        return self.query_target('DOIs.txt')
     
     def run(self):
         with ExitStack() as stack:
@@ -333,7 +785,7 @@ class GetDOIs(GBIFTask):
             outfile = stack.enter_context(self.output().open('w'))
             s = stack.enter_context(requests.Session())
             download_ids = infile.read().splitlines()
-            s.mount(self.url, self.adapter)
+            self.mount(s)
             for download_id in download_ids:
                 r = s.get(self.url + 'occurrence/download/' + download_id)
                 if r.status_code == requests.codes.ok:
@@ -341,16 +793,21 @@ class GetDOIs(GBIFTask):
                     outfile.write(doi + '\n')
                         
                 
-class GetDownloadLinks(GBIFTask):
+class GetDownloadLinks(QueryTask, GBIFTask):
     
     # This task checks the status of the previously submitted download requests
-    # and returns a list of download links.
+    # and returns a list of download links. All requests are polled together
+    # and each link is written as soon as its download has been prepared.
     
+    poll_deadline = luigi.TimeDeltaParameter(
+        default=datetime.timedelta(hours=24))
+    max_poll_interval = 120
+
     def requires(self):
-        return PostUsageKeys()
+        return self.for_query(PostUsageKeys)
     
     def output(self):
-        return luigi.LocalTarget('data/download-links.txt')
+        return self.query_target('download-links.txt')
     
     def run(self):
         with ExitStack() as stack:
@@ -358,56 +815,206 @@ class GetDownloadLinks(GBIFTask):
             outfile = stack.enter_context(self.output().open('w'))
             s = stack.enter_context(requests.Session())
             download_ids = infile.read().splitlines()
-            s.mount(self.url, self.adapter)
-            for i, download_id in enumerate(download_ids):
-                message = 'Progress: {0:.0%}'.format(i / len(download_ids))
-                self.set_status_message(message)
-                print(message)
-                url = self.url + 'occurrence/download/' + download_id
-                retry_max = 250
-                for j in range(retry_max):
-                    download_link = utils.get_download_link(s, url, self.timeout)
-                    if download_link:
-                        outfile.write(download_link + '\n')
-                        break
-                    else:
-                        time.sleep(30)
-                        continue
-                else:
-                    err_msg = ('Exceeded max retries while attempting to fetch '
-                                'download link.')
-                    raise Exception(err_msg)
+            self.mount(s)
+            url = self.url + 'occurrence/download/'
+            args = [s, url, download_ids, self.timeout,
+                    self.poll_deadline.total_seconds(), self.max_poll_interval,
+                    self.metrics]
+            polled = utils.poll_downloads(*args)
+            for i, (download_id, download_link) in enumerate(polled):
+                self.progress.update('Progress: {0:.0%}', (i + 1) / len(download_ids))
+                outfile.write(download_link + '\n')
                             
             
-class DownloadOccurrences(GBIFTask):
+class DownloadOccurrences(QueryTask, GBIFTask):
 
     # This task downloads and consolidates the zipped occurrence datasets using
     # the previous list of download links.
     
+    # Archives are streamed to 'spool_dir' before they are consolidated, so
+    # an interrupted download is resumed rather than restarted.
+    spool_dir = luigi.Parameter(default='data/spool')
+    max_parallel_downloads = luigi.IntParameter(default=4)
+    download_timeout = 120
+    # With --keep-archives, the archives are not recompressed into a single
+    # zip file. They are moved unchanged into 'archive_dir', named by the
+    # SHA-256 digest of their contents, and listed in a manifest instead.
+    # Archives that an interrupted attempt finished fetching are recorded in
+    # its journal and are not requested again. Kept archives are added to
+    # the species store, if it is enabled, under the species keys they were
+    # requested for.
+    keep_archives = luigi.BoolParameter(default=False)
+    archive_dir = luigi.Parameter(default='data/archives')
+
     def requires(self):
-        return GetDownloadLinks()
+        return self.for_query(GetDownloadLinks)
     
     def output(self):
-        return luigi.LocalTarget('data/occurrences.zip', format=luigi.format.Nop)
+        if self.keep_archives:
+            return self.query_target('occurrences-manifest.txt')
+        return self.query_target('occurrences.zip', format=luigi.format.Nop)
     
     def run(self):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        if self.keep_archives:
+            os.makedirs(self.archive_dir, exist_ok=True)
         with ExitStack() as stack:
             infile = stack.enter_context(self.input().open('r'))
             outfile = stack.enter_context(self.output().open('w'))
             s = stack.enter_context(requests.Session())
             s.mount(self.url, self.adapter)
+            self.instrument(s)
+            executor = stack.enter_context(
+                ThreadPoolExecutor(max_workers=self.max_parallel_downloads))
+            if not self.keep_archives:
+                archive = stack.enter_context(ZipFile(outfile, 'w',
+                    compression=zipfile.ZIP_DEFLATED))
             download_links = infile.read().splitlines()
-            with ZipFile(outfile, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
-                for i, download_link in enumerate(download_links):
-                    message = 'Progress: {0:.0%}'.format(i / len(download_links))
-                    self.set_status_message(message)
-                    print(message)
-                    with s.get(download_link, stream=True, timeout=120) as r:
-                        if r.status_code == requests.codes.ok:
-                            stream = io.BytesIO(r.content)
-                            utils.copy_stream(stream, archive)
+            spool_paths = [os.path.join(self.spool_dir, utils.file_name(link))
+                           for link in download_links]
+            context = {'links':download_links,
+                       'keep_archives':self.keep_archives}
+            journal = stack.enter_context(self.journal(context))
+            fetched = {record['path']: record['row']
+                       for record in journal.records}
+            store = None
+            if self.keep_archives and SpeciesStore().enabled:
+                store = stack.enter_context(SpeciesStore().open())
+                # Download IDs posted before the keys were listed have none.
+                requested = {}
+                keys_target = self.for_query(PostUsageKeys).requested_keys()
+                if keys_target.exists():
+                    with keys_target.open('r') as keys_file:
+                        requested = json.load(keys_file)
+            futures = [None if path in fetched
+                       else executor.submit(utils.download_file, s, link,
+                                            path, self.download_timeout)
+                       for link, path in zip(download_links, spool_paths)]
+            for i, (future, path) in enumerate(zip(futures, spool_paths)):
+                self.progress.update('Progress: {0:.0%}', i / len(futures))
+                if future is not None:
+                    future.result()
+                if self.keep_archives:
+                    data = fetched.get(path)
+                    if data is None:
+                        download_id = os.path.splitext(
+                            os.path.basename(path))[0]
+                        digest = utils.hash_file(path)
+                        archive_path = os.path.join(self.archive_dir,
+                                                    digest + '.zip')
+                        os.replace(path, archive_path)
+                        data = [download_id, digest, archive_path]
+                        journal.append({'path':path, 'row':data})
+                    outfile.write(','.join(data) + '\n')
+                    if store is not None:
+                        store.add_archive(requested.get(data[0], []), data[2])
+                else:
+                    if future is not None:
+                        journal.append({'path':path, 'row':None})
+                    utils.copy_stream(path, archive)
+        for path in spool_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        journal.discard()
                                 
 
+class WaitForDownload(GBIFTask):
+
+    # This task checks the status of a single download request until it has
+    # been prepared and returns its download link.
+
+    download_id = luigi.Parameter()
+    poll_deadline = luigi.TimeDeltaParameter(
+        default=datetime.timedelta(hours=24))
+    max_poll_interval = 120
+
+    def output(self):
+        return luigi.LocalTarget(
+            'data/downloads/{}-link.txt'.format(self.download_id))
+
+    def run(self):
+        with ExitStack() as stack:
+            s = stack.enter_context(requests.Session())
+            self.mount(s)
+            url = self.url + 'occurrence/download/'
+            args = [s, url, [self.download_id], self.timeout,
+                    self.poll_deadline.total_seconds(), self.max_poll_interval,
+                    self.metrics]
+            download_id, download_link = next(utils.poll_downloads(*args))
+            outfile = stack.enter_context(self.output().open('w'))
+            outfile.write(download_link + '\n')
+
+
+class FetchDownload(GBIFTask):
+
+    # This task downloads the zipped occurrence dataset of a single download
+    # request. The archive is kept as it was downloaded.
+
+    download_id = luigi.Parameter()
+    download_timeout = 120
+
+    def requires(self):
+        return WaitForDownload(download_id=self.download_id)
+
+    def output(self):
+        return luigi.LocalTarget('data/downloads/{}.zip'.format(self.download_id),
+            format=luigi.format.Nop)
+
+    def run(self):
+        # The partial file is kept between runs so that it can be resumed.
+        spool_path = self.output().path + '.part'
+        with ExitStack() as stack:
+            infile = stack.enter_context(self.input().open('r'))
+            s = stack.enter_context(requests.Session())
+            s.mount(self.url, self.adapter)
+            self.instrument(s)
+            download_link = infile.read().strip()
+            utils.download_file(s, download_link, spool_path,
+                                self.download_timeout)
+        os.replace(spool_path, self.output().path)
+
+
+class FilterDownload(luigi.Task):
+
+    # This task filters the occurrence dataset of a single download request
+    # in the same way as ConsolidateAndFilterOccurrences.
+
+    download_id = luigi.Parameter()
+    coord_uncertainty_limit = luigi.IntParameter()
+    columnar = luigi.BoolParameter()
+    chunk_size = luigi.IntParameter()
+    with_uncertainty = luigi.BoolParameter()
+
+    def requires(self):
+        return [FetchDownload(download_id=self.download_id), GetRasterMetadata()]
+
+    def output(self):
+        # The limit is part of the name, since a download filtered under
+        # another limit would otherwise be taken as complete.
+        name = 'downloads/{}-filtered-{}'.format(self.download_id,
+                                                 self.coord_uncertainty_limit)
+        if self.with_uncertainty:
+            name += '-with-uncertainty'
+        return Intermediates().target(name)
+
+    def run(self):
+        with ExitStack() as stack:
+            infile = stack.enter_context(self.input()[1].open('r'))
+            outfile = stack.enter_context(self.output().open('w'))
+            metadata = pickle.load(infile, encoding='utf-8')
+            bounds = utils.raster_bounds(metadata)
+            path = self.input()[0].path
+            with ZipFile(path) as archive:
+                member = archive.infolist()[0].filename
+            file_format = Intermediates().file_format
+            if file_format == 'parquet':
+                outfile = stack.enter_context(utils.pq.ParquetWriter(outfile,
+                    utils.occurrence_schema(self.with_uncertainty)))
+            utils.filter_dataset(path, member, self.coord_uncertainty_limit,
+                bounds, self.columnar, self.chunk_size, self.with_uncertainty,
+                file_format, outfile)
+
+
 class GetRasterMetadata(luigi.Task):
     
     # This task stores metadata for the first raster file as a Pickle object.
@@ -419,8 +1026,7 @@ class GetRasterMetadata(luigi.Task):
     def run(self):    
         with ExitStack() as stack:
             outfile = stack.enter_context(self.output().open('w'))
-            raster_dir = stack.enter_context(os.scandir('raster'))
-            fpath = next(raster_dir).path
+            fpath = utils.list_raster_files('raster')[0]
             raster_data = stack.enter_context(rasterio.open(fpath))
             pickle.dump(raster_data.meta, outfile)
             
@@ -430,6 +1036,15 @@ class StackRasterData(luigi.Task):
     # This task iterates through the list of raster files and writes them to a 
 	# new raster file as individual bands. A "stacked" raster file is returned.
 
+    # With --tiled, the stacked raster file is written as a tiled, compressed
+    # and pixel-interleaved GeoTIFF, one window of tiles at a time, with the
+    # bands of each window read, and its tiles compressed, by up to
+    # 'max_parallel_reads' threads. This keeps memory use bounded at any
+    # resolution and speeds up point sampling.
+    tiled = luigi.BoolParameter(default=False)
+    tile_size = luigi.IntParameter(default=256)
+    max_parallel_reads = luigi.IntParameter(default=4)
+
     def requires(self):
         return GetRasterMetadata()
 
@@ -441,143 +1056,818 @@ class StackRasterData(luigi.Task):
         with ExitStack() as stack:
             infile = stack.enter_context(self.input().open('r'))
             outfile = stack.enter_context(self.output().open('w'))
-            raster_files = os.listdir('raster')
+            raster_files = utils.list_raster_files('raster')
             metadata = pickle.load(infile, encoding='utf-8')
             metadata.update(count=len(raster_files))
+            if self.tiled:
+                self.write_tiled(stack, outfile, raster_files, metadata)
+                return
             stacked = stack.enter_context(rasterio.open(outfile,'w', **metadata))
-            for i, file_name in enumerate(raster_files):
-                message = 'Progress: {0:.0%}'.format(i / len(raster_files))
-                self.set_status_message(message)
-                print(message)
-                band = int(file_name[15:-4])
-                with rasterio.open('raster/' + file_name) as source:
-                    stacked.write_band(band, source.read(1))
+            for i, path in enumerate(raster_files):
+                self.progress.update('Progress: {0:.0%}', i / len(raster_files))
+                with rasterio.open(path) as source:
+                    stacked.write_band(i + 1, source.read(1))
+
+    def write_tiled(self, stack, outfile, raster_files, metadata):
+        # Writes the bands window by window, so that only one window of every
+        # band is held in memory at a time.
+        floating = np.issubdtype(np.dtype(metadata['dtype']), np.floating)
+        metadata.update(tiled=True,
+                        blockxsize=self.tile_size,
+                        blockysize=self.tile_size,
+                        compress='deflate',
+                        predictor=3 if floating else 2,
+                        interleave='pixel',
+                        bigtiff='if_safer',
+                        num_threads=self.max_parallel_reads
+                        )
+        stacked = stack.enter_context(rasterio.open(outfile,'w', **metadata))
+        executor = stack.enter_context(
+            ThreadPoolExecutor(max_workers=self.max_parallel_reads))
+        windows = utils.tile_windows(stacked.width, stacked.height,
+            self.tile_size)
+        for i, window in enumerate(windows):
+            self.progress.update('Progress: {0:.0%}', i / len(windows))
+            bands = executor.map(utils.read_window, raster_files,
+                [window] * len(raster_files))
+            stacked.write(np.stack(list(bands)), window=window)
             
 
-class ConsolidateAndFilterOccurrences(luigi.Task):
+class BuildClimateCube(luigi.Task):
+
+    # This task copies the stacked raster file into a memory-mapped array of
+    # shape (height, width, bands), so that the bands of a pixel are stored
+    # next to each other and each point can be sampled with a single read.
+    # The transform and nodata value of the raster are stored alongside it.
+
+    # With --scaled, values are stored as int16 with a scale and offset per
+    # band, halving the size of the cube at the cost of some precision.
+    scaled = luigi.BoolParameter(default=False)
+
+    def requires(self):
+        return StackRasterData()
+
+    def output(self):
+        # Scaled and unscaled cubes are kept apart, so that toggling --scaled
+        # builds the other one rather than reusing the cube already there.
+        name = 'data/climate-cube'
+        if self.scaled:
+            name += '-scaled'
+        return [luigi.LocalTarget(name + '.npy', format=luigi.format.Nop),
+                luigi.LocalTarget(name + '.pickle', format=luigi.format.Nop)
+                ]
+
+    def run(self):
+        with ExitStack() as stack:
+            stacked = stack.enter_context(rasterio.open(self.input().path))
+            cube_path = stack.enter_context(self.output()[0].temporary_path())
+            outfile = stack.enter_context(self.output()[1].open('w'))
+            info = utils.climate_cube_info(stacked, self.scaled)
+            shape = (stacked.height, stacked.width, stacked.count)
+            cube = np.lib.format.open_memmap(cube_path, mode='w+',
+                dtype=info['dtype'], shape=shape)
+            windows = utils.row_windows(stacked)
+            for i, window in enumerate(windows):
+                self.progress.update('Progress: {0:.0%}', i / len(windows))
+                utils.write_cube_window(stacked, cube, window, info)
+            cube.flush()
+            del cube
+            pickle.dump(info, outfile)
+
+
+class BuildSummedAreaTables(luigi.Task):
+
+    # This task builds memory-mapped summed-area tables of the sum and number
+    # of valid values of each band of the stacked raster file, so that the
+    # mean of any rectangular window can be read with four lookups. The
+    # offsets subtracted from each band before summing, and the transform and
+    # nodata value of the raster, are stored alongside them.
+
+    def requires(self):
+        return StackRasterData()
+
+    def output(self):
+        return [luigi.LocalTarget('data/summed-area-sums.npy',
+                    format=luigi.format.Nop),
+                luigi.LocalTarget('data/summed-area-counts.npy',
+                    format=luigi.format.Nop),
+                luigi.LocalTarget('data/summed-area-tables.pickle',
+                    format=luigi.format.Nop)
+                ]
+
+    def run(self):
+        with ExitStack() as stack:
+            stacked = stack.enter_context(rasterio.open(self.input().path))
+            sums_path = stack.enter_context(self.output()[0].temporary_path())
+            counts_path = stack.enter_context(
+                self.output()[1].temporary_path())
+            outfile = stack.enter_context(self.output()[2].open('w'))
+            info = utils.summed_area_info(stacked)
+            shape = (stacked.height + 1, stacked.width + 1, stacked.count)
+            sums = np.lib.format.open_memmap(sums_path, mode='w+',
+                dtype=np.float64, shape=shape)
+            counts = np.lib.format.open_memmap(counts_path, mode='w+',
+                dtype=np.int32, shape=shape)
+            windows = utils.row_windows(stacked)
+            for i, window in enumerate(windows):
+                self.progress.update('Progress: {0:.0%}', i / len(windows))
+                utils.write_summed_area_window(stacked, sums, counts, window,
+                    info)
+            sums.flush()
+            counts.flush()
+            del sums, counts
+            pickle.dump(info, outfile)
+
+
+class ConsolidateAndFilterOccurrences(QueryTask):
 
     # This task iterates through the occurrence datasets and returns a
     # consolidated and filtered list of species keys and coordinates.
 
     # The coordinate uncertainty limit should be chosen based on the resolution 
 	# of the raster data.
-	coord_uncertainty_limit = luigi.IntParameter(default=4625)
+    coord_uncertainty_limit = luigi.IntParameter(default=4625)
+    # With --columnar, each occurrence dataset is parsed in chunks of
+    # 'chunk_size' rows, reading only the columns that are needed, and
+    # filtered with NumPy masks.
+    columnar = luigi.BoolParameter(default=False)
+    chunk_size = luigi.IntParameter(default=1000000)
+    # Number of processes used to decompress and filter datasets in parallel.
+    processes = luigi.IntParameter(default=1)
+    # With --fan-out, each download ID is polled, fetched and filtered by its
+    # own chain of tasks, which 'luigi --workers N' can run side by side, and
+    # this task only merges their results.
+    fan_out = luigi.BoolParameter(default=False)
+    # With --with-uncertainty, the coordinate uncertainty of each record is
+    # kept as a fourth column for buffered sampling.
+    with_uncertainty = luigi.BoolParameter(default=False)
+    # With --dedupe gbif-id, a record that appears more than once across the
+    # datasets is kept only the first time. With --dedupe location, so is a
+    # record of the same species at the same coordinates rounded to
+    # 'dedupe_digits' decimal places. Records are compared by 64-bit hashes
+    # in at most about 'dedupe_memory' MB, beyond which they are spilled to
+    # disk. Not supported with --fan-out.
+    dedupe = luigi.ChoiceParameter(choices=['off', 'gbif-id', 'location'],
+                                   default='off')
+    dedupe_digits = luigi.IntParameter(default=4)
+    dedupe_memory = luigi.IntParameter(default=512)
     
     def requires(self):
-        return [DownloadOccurrences(), GetRasterMetadata()]
+        if self.fan_out:
+            return [self.for_query(PostUsageKeys), GetRasterMetadata()]
+        return [self.for_query(DownloadOccurrences), GetRasterMetadata()]
     
     def output(self):
-        return luigi.LocalTarget('data/consolidated-filtered-occurrences.txt')
+        name = 'consolidated-filtered-occurrences'
+        if self.with_uncertainty:
+            name += '-with-uncertainty'
+        if self.dedupe == 'gbif-id':
+            name += '-distinct'
+        elif self.dedupe == 'location':
+            name += '-distinct-{}'.format(self.dedupe_digits)
+        return Intermediates().target(name, self.query_dir)
     
+    def list_datasets(self):
+        # Returns the archive path and member name of each occurrence dataset,
+        # whether the downloads were consolidated into a single zip file or
+        # kept as they were downloaded, followed by any stored archives that
+        # are sampled again. The third item is the list of species keys whose
+        # records are read from the dataset, or None for all of them.
+        download = self.input()[0]
+        if self.requires()[0].keep_archives:
+            with download.open('r') as manifest:
+                paths = [line.split(',')[2] for line
+                         in manifest.read().splitlines()]
+            datasets = []
+        else:
+            with ZipFile(download.path) as archive:
+                datasets = [(download.path, info.filename, None)
+                            for info in archive.infolist()]
+            paths = []
+        for path in paths:
+            with ZipFile(path) as archive:
+                datasets.append((path, archive.infolist()[0].filename, None))
+        if SpeciesStore().reuse_archives(self):
+            for path, species_keys in self.stored_archives().items():
+                if path in paths:
+                    continue
+                with ZipFile(path) as archive:
+                    datasets.append((path, archive.infolist()[0].filename,
+                                     species_keys))
+        return datasets
+
+    def stored_archives(self):
+        # Returns the stored archives of the species keys of this query that
+        # were not downloaded again for that reason, with the species keys to
+        # read from each, since an archive also holds the other species it was
+        # requested for. Species keys that the previous run covered, or whose
+        # aggregates are stored by now, are left out, since
+        # AggregateClimateData takes them from elsewhere.
+        target = self.for_query(RemoveDuplicateSpeciesKeys).output()
+        with target.open('r') as infile:
+            species_keys = set(infile.read().splitlines())
+        manifest = Incremental().load_manifest(self)
+        if manifest:
+            species_keys.difference_update(manifest['species_keys'])
+        species_store = SpeciesStore()
+        with species_store.open() as store:
+            species_keys.difference_update(store.aggregated_keys(
+                species_store.profile(self), species_keys))
+            archives = store.archives(species_keys)
+        wanted = {}
+        for species_key, paths in archives.items():
+            for path in paths:
+                wanted.setdefault(path, []).append(species_key)
+        return {path: sorted(wanted[path]) for path in sorted(wanted)}
+
     def run(self):
-        with ExitStack() as outer_stack:
-            infiles = [outer_stack.enter_context(input.open('r'))
-						for input in self.input()]
-			outfile = outer_stack.enter_context(self.output().open('w'))
-            archive = outer_stack.enter_context(ZipFile(infiles[0], 'r'))
-            files = archive.infolist()
+        if self.fan_out:
+            if self.dedupe != 'off':
+                raise Exception('--dedupe is not supported with --fan-out')
+            yield from self.merge_downloads()
+            return
+        with ExitStack() as stack:
+            infile = stack.enter_context(self.input()[1].open('r'))
+            outfile = stack.enter_context(self.output().open('w'))
+            metadata = pickle.load(infile, encoding='utf-8')
+            bounds = utils.raster_bounds(metadata)
+            datasets = self.list_datasets()
+            file_format = Intermediates().file_format
+            args = [self.coord_uncertainty_limit, bounds, self.columnar,
+                    self.chunk_size, self.with_uncertainty, file_format]
+            if file_format == 'parquet':
+                outfile = stack.enter_context(utils.pq.ParquetWriter(outfile,
+                    utils.occurrence_schema(self.with_uncertainty)))
+            if self.processes > 1 or self.dedupe != 'off':
+                tmp_dir = stack.enter_context(tempfile.TemporaryDirectory(
+                    dir=os.path.dirname(self.output().path)))
+            duplicates = None
+            if self.dedupe != 'off':
+                duplicates = utils.DuplicateFilter(self.dedupe,
+                    self.dedupe_digits, tmp_dir, self.dedupe_memory * 2**20)
+            if self.processes > 1:
+                # Each dataset is filtered into a part file by a worker process
+                # and the parts are appended to the output in order. Duplicates
+                # are dropped here, by the hashes saved with each part.
+                dedupe = None
+                if duplicates is not None:
+                    dedupe = (self.dedupe, self.dedupe_digits)
+                executor = stack.enter_context(
+                    ProcessPoolExecutor(max_workers=self.processes))
+                futures = [executor.submit(utils.filter_dataset_to_file,
+                                           os.path.join(tmp_dir, str(i)),
+                                           path, name, *args, dedupe=dedupe,
+                                           species_keys=species_keys)
+                           for i, (path, name, species_keys)
+                           in enumerate(datasets)]
+            for i, (path, name, species_keys) in enumerate(datasets):
+                self.progress.update('Progress: {0:.0%}', i / len(datasets))
+                if self.processes > 1:
+                    part = futures[i].result()
+                    utils.append_part_file(part, outfile, file_format,
+                                           duplicates, self.chunk_size)
+                    os.remove(part)
+                    if duplicates is not None:
+                        os.remove(utils.part_hashes_path(part))
+                else:
+                    utils.filter_dataset(path, name, *args, outfile,
+                                         duplicates, species_keys)
+            if duplicates is not None:
+                self.metrics.add('rows_in', duplicates.seen)
+                self.metrics.add('rows_out',
+                                 duplicates.seen - duplicates.dropped)
+                self.metrics.add('duplicates_dropped', duplicates.dropped)
+                print('Dropped {} duplicate records of {}'.format(
+                    duplicates.dropped, duplicates.seen))
+
+    def merge_downloads(self):
+        # Yields a FilterDownload task for each download ID as a dynamic
+        # dependency and appends their outputs in order. Nothing is written
+        # before the yield, since Luigi calls run() again from the start once
+        # the dependencies are complete.
+        with self.input()[0].open('r') as infile:
+            download_ids = infile.read().splitlines()
+        filtered = yield [FilterDownload(download_id=download_id,
+            coord_uncertainty_limit=self.coord_uncertainty_limit,
+            columnar=self.columnar, chunk_size=self.chunk_size,
+            with_uncertainty=self.with_uncertainty)
+            for download_id in download_ids]
+        file_format = Intermediates().file_format
+        with ExitStack() as stack:
+            outfile = stack.enter_context(self.output().open('w'))
+            if file_format == 'parquet':
+                outfile = stack.enter_context(utils.pq.ParquetWriter(outfile,
+                    utils.occurrence_schema(self.with_uncertainty)))
+            for i, target in enumerate(filtered):
+                self.progress.update('Progress: {0:.0%}', i / len(filtered))
+                utils.append_part_file(target.path, outfile, file_format)
+
+
+class PartitionOccurrences(QueryTask):
+
+    # This task splits the filtered and consolidated occurrences into shards
+    # of 'shard_size' by 'shard_size' raster cells, keyed on the cell each
+    # occurrence falls in under the transform of the raster metadata, and
+    # returns a list of the shards and their number of occurrences. Records
+    # keep their order within each shard. Rows are buffered per shard and,
+    # once 'buffer_size' rows are held, written out to a part file per shard,
+    # so that only one file is open at a time however many shards there are.
+
+    shard_size = luigi.IntParameter()
+    chunk_size = luigi.IntParameter(default=100000)
+    buffer_size = luigi.IntParameter(default=1000000)
+
+    def requires(self):
+        return [self.for_query(ConsolidateAndFilterOccurrences),
+                GetRasterMetadata()]
+
+    def output(self):
+        return self.query_target(
+            'occurrence-shards-{}.txt'.format(self.shard_size))
+
+    def shard_target(self, shard_row, shard_col, name):
+        return Intermediates().target('shards-{}/{}-{}-{}'.format(
+            self.shard_size, shard_row, shard_col, name), self.query_dir)
+
+    def run(self):
+        # Shards sampled from an earlier partition would otherwise be taken
+        # as complete.
+        shard_dir = os.path.join(self.query_dir,
+                                 'shards-{}'.format(self.shard_size))
+        if os.path.exists(shard_dir):
+            shutil.rmtree(shard_dir)
+        os.makedirs(shard_dir)
+        file_format = Intermediates().file_format
+        with ExitStack() as stack:
+            infiles = [stack.enter_context(f.open('r')) for f in self.input()]
+            tmp_dir = stack.enter_context(tempfile.TemporaryDirectory(
+                dir=self.query_dir))
             metadata = pickle.load(infiles[1], encoding='utf-8')
-            xmin, ymin = metadata['transform'] * (0, metadata['height'])
-            xmax, ymax = metadata['transform'] * (metadata['width'], 0)
-            bounds = {'xmin': xmin, 'xmax': xmax, 'ymin': ymin, 'ymax': ymax}
-            for i, file in enumerate(files):
-                message = 'Progress: {0:.0%}'.format(i / len(files))
-                self.set_status_message(message)
-                print(message)
-                with ExitStack() as inner_stack:
-                    binary = inner_stack.enter_context(archive.open(file))
-                    text = inner_stack.enter_context(io.TextIOWrapper(binary,
-                        encoding='utf-8'))
-                    reader = csv.reader(text, delimiter='\t',
-                        quoting=csv.QUOTE_NONE)
-                    next(reader) # Skips header.
-                    for row in reader:                
-                        coord_uncertainty = row[18]
-                        x = row[17] #longitude
-                        y = row[16] #latitude
-                        species_key = row[29]
-                        args = [coord_uncertainty, x, y,
-                                self.coord_uncertainty_limit, bounds]
-                        filter_ = utils.validate_and_filter(*args)
-                        if filter_:
-                            data = {'skey':species_key}
-                            data.update(filter_)
-                            outfile.write('{skey},{x},{y}\n'.format(**data))
-
-
-class SampleRasterData(luigi.Task):
+            raster = [metadata['transform'], metadata['width'],
+                      metadata['height']]
+            if file_format == 'parquet':
+                chunks = utils.read_occurrence_batches(infiles[0],
+                    self.chunk_size)
+            else:
+                chunks = utils.read_occurrence_chunks(infiles[0],
+                    self.chunk_size)
+            buffers = collections.defaultdict(list)
+            parts = collections.defaultdict(list)
+            counts = collections.Counter()
+            buffered = 0
+            for species_keys, x, y in chunks:
+                self.metrics.add('rows_in', len(species_keys))
+                shard_rows, shard_cols = utils.shard_indices(*raster, x, y,
+                    self.shard_size)
+                keys = shard_rows * metadata['width'] + shard_cols
+                order = np.argsort(keys, kind='stable')
+                unique, starts = np.unique(keys[order], return_index=True)
+                for group in np.split(order, starts[1:]):
+                    shard = (int(shard_rows[group[0]]),
+                             int(shard_cols[group[0]]))
+                    buffers[shard].append((species_keys[group], x[group],
+                                           y[group]))
+                    counts[shard] += len(group)
+                buffered += len(species_keys)
+                if buffered >= self.buffer_size:
+                    for shard, rows in buffers.items():
+                        part_path = os.path.join(tmp_dir, '{}-{}-{}'.format(
+                            *shard, len(parts[shard])))
+                        utils.write_occurrence_part(part_path, rows,
+                                                    file_format)
+                        parts[shard].append(part_path)
+                    buffers.clear()
+                    buffered = 0
+            for shard in sorted(counts):
+                target = self.shard_target(*shard, 'occurrences')
+                with ExitStack() as shard_stack:
+                    outfile = shard_stack.enter_context(target.open('w'))
+                    if file_format == 'parquet':
+                        outfile = shard_stack.enter_context(
+                            utils.pq.ParquetWriter(outfile,
+                                utils.occurrence_schema()))
+                    for part_path in parts[shard]:
+                        utils.append_part_file(part_path, outfile, file_format)
+                        os.remove(part_path)
+                    utils.write_occurrence_rows(outfile,
+                        buffers.pop(shard, []), file_format)
+        with self.output().open('w') as outfile:
+            for (shard_row, shard_col), count in sorted(counts.items()):
+                outfile.write('{},{},{}\n'.format(shard_row, shard_col,
+                                                  count))
 
-    # This task iterates through the list of filtered and consolidated species 
-	# keys and coordinates and samples the raster file at each band.
+
+class SampleShard(QueryTask):
+
+    # This task samples the stacked raster at the occurrences of one shard.
+    # Since they all fall within a single square of the raster, only the
+    # blocks of that square are read, each of them once per chunk, and they
+    # stay in the block cache between chunks. Shards can be run by separate
+    # workers, on any machine that shares the data directory.
+
+    shard_size = luigi.IntParameter()
+    shard_row = luigi.IntParameter()
+    shard_col = luigi.IntParameter()
+    chunk_size = luigi.IntParameter()
+    thin = luigi.BoolParameter()
 
     def requires(self):
-        return [ConsolidateAndFilterOccurrences(),
+        return [self.for_query(PartitionOccurrences,
+                               shard_size=self.shard_size),
                 StackRasterData(),
                 GetRasterMetadata()
-				]
+                ]
+
+    def output(self):
+        name = 'climate-data-thinned' if self.thin else 'climate-data'
+        return self.requires()[0].shard_target(self.shard_row, self.shard_col,
+                                               name)
+
+    def run(self):
+        parquet = Intermediates().parquet
+        partition = self.requires()[0]
+        occurrences = partition.shard_target(self.shard_row, self.shard_col,
+                                             'occurrences')
+        with ExitStack() as stack:
+            infile = stack.enter_context(occurrences.open('r'))
+            stacked = stack.enter_context(rasterio.open(self.input()[1].path))
+            with self.input()[2].open('r') as metadata_file:
+                metadata = pickle.load(metadata_file, encoding='utf-8')
+            outfile = stack.enter_context(self.output().open('w'))
+            raster = [metadata['transform'], metadata['width'],
+                      metadata['height']]
+            if parquet:
+                col_names = ['BIO' + str(i) for i in range(1, stacked.count + 1)]
+                writer = stack.enter_context(utils.pq.ParquetWriter(outfile,
+                    utils.climate_schema(col_names)))
+                chunks = utils.read_occurrence_batches(infile, self.chunk_size)
+            else:
+                writer = csv.writer(outfile, lineterminator='\n')
+                chunks = utils.read_occurrence_chunks(infile, self.chunk_size)
+            # Every cell lies in a single shard, so thinning each shard on its
+            # own keeps the same occurrences as thinning them all at once.
+            thinner = utils.CellThinner(metadata['width'], metadata['height'])
+            for species_keys, x, y in chunks:
+                self.metrics.add('rows_in', len(species_keys))
+                if self.thin:
+                    cells = utils.cell_indices(*raster, x, y)
+                    keep = thinner.keep(species_keys, cells)
+                    species_keys, x, y = species_keys[keep], x[keep], y[keep]
+                samples = utils.sample_raster(stacked, x, y)
+                utils.write_climate_samples(writer, species_keys, samples,
+                    metadata['nodata'], parquet)
+                self.metrics.add('rows_out', len(species_keys))
+
+
+class SampleRasterData(QueryTask):
+
+    # This task iterates through the list of filtered and consolidated species 
+	# keys and coordinates and samples the raster file at each band.
+
+    def requires(self):
+        required = [self.for_query(ConsolidateAndFilterOccurrences,
+                        with_uncertainty=self.buffered),
+                    StackRasterData(),
+                    GetRasterMetadata()
+                    ]
+        if self.cube:
+            required.append(BuildClimateCube())
+        if self.buffered:
+            required.append(BuildSummedAreaTables())
+        if self.shard_size:
+            required.append(self.for_query(PartitionOccurrences,
+                                           shard_size=self.shard_size))
+        return required
     
+    # With --batched, occurrences are read and sampled in chunks of
+    # 'chunk_size' records so that memory use does not grow with their number.
+    batched = luigi.BoolParameter(default=False)
+    chunk_size = luigi.IntParameter(default=100000)
+    # With --cube, occurrences are sampled in chunks from the memory-mapped
+    # climate cube instead of the stacked raster file.
+    cube = luigi.BoolParameter(default=False)
+    # With --dedupe-cells, occurrences are sampled in chunks and each raster
+    # cell is sampled once per chunk, however many occurrences fall in it.
+    # With --thin, only the first occurrence of each species in each raster
+    # cell is kept, so that the aggregated means are not biased towards
+    # densely sampled areas.
+    dedupe_cells = luigi.BoolParameter(default=False)
+    thin = luigi.BoolParameter(default=False)
+    # With --buffered, each variable is averaged over a window sized to the
+    # coordinate uncertainty of the occurrence, using summed-area tables so
+    # that every window costs the same whatever its size. Occurrences with
+    # an uncertainty of under half a pixel are sampled as before. Since the
+    # uncertainty is averaged over rather than ignored, a higher
+    # --ConsolidateAndFilterOccurrences-coord-uncertainty-limit can be used.
+    # --dedupe-cells has no effect on buffered sampling.
+    buffered = luigi.BoolParameter(default=False)
+    # With --shard-size, occurrences are partitioned into squares of that
+    # many raster cells a side, ideally a multiple of
+    # --StackRasterData-tile-size, and each square is sampled by a
+    # SampleShard task of its own, so that the work is spread over all
+    # workers. The output holds the same rows, grouped by square. It can be
+    # combined with --thin, but not with --cube or --buffered.
+    shard_size = luigi.IntParameter(default=0)
+
     def output(self):
-        return luigi.LocalTarget('data/occurrences-climate-data.txt')
+        return Intermediates().target(
+            'occurrences-climate-data' + self.variant(), self.query_dir)
+
+    def variant(self):
+        # Returns the suffix naming the outputs of this task and of the tasks
+        # that aggregate them, so that toggling a setting that changes the
+        # samples takes them again rather than reusing stale ones. Occurrences
+        # are always thinned to the cells of the raster, so no other cell size
+        # is named. Buffered samples are named after the coordinate
+        # uncertainty limit, which bounds the radius of their windows, and
+        # samples of a scaled climate cube are named as such.
+        suffix = ''
+        if self.thin:
+            suffix += '-thinned'
+        if self.buffered:
+            suffix += '-buffered-{}m'.format(
+                self.requires()[0].coord_uncertainty_limit)
+        if self.cube and BuildClimateCube().scaled:
+            suffix += '-scaled'
+        return suffix
     
     def run(self):
+        if self.shard_size:
+            yield from self.merge_shards()
+            return
         with ExitStack() as stack:
             infiles = [stack.enter_context(input.open('r')) for input
-						in self.input()]
-			stacked = stack.enter_context(rasterio.open(infiles[1]))
+						in self.input()[:3]]
+            stacked = stack.enter_context(rasterio.open(infiles[1]))
             outfile = stack.enter_context(self.output().open('w'))
             metadata = pickle.load(infiles[2], encoding='utf-8')
             nodata = metadata['nodata']
+            indexes = list(range(1, stacked.count + 1))
+            col_names = ['BIO' + str(i) for i in indexes]
+            if self.cube:
+                cube_target, info_target = BuildClimateCube().output()
+                with info_target.open('r') as info_file:
+                    info = pickle.load(info_file)
+                cube = utils.open_climate_cube(cube_target.path, info, metadata)
+                sample = functools.partial(utils.sample_climate_cube, cube,
+                    info)
+            else:
+                sample = functools.partial(utils.sample_raster, stacked)
+            if self.buffered:
+                sample = self.buffered_sampler(sample, metadata)
+            if Intermediates().parquet:
+                # Parquet tables are always sampled in chunks.
+                schema = utils.climate_schema(col_names)
+                writer = stack.enter_context(utils.pq.ParquetWriter(outfile,
+                    schema))
+                chunks = utils.read_occurrence_batches(infiles[0],
+                    self.chunk_size, self.buffered)
+                self.sample_in_chunks(chunks, sample, metadata, writer)
+                return
+            header = ['Species Key'] + col_names
+            outfile.write(','.join(header) + '\n')
+            if (self.batched or self.cube or self.dedupe_cells or self.thin
+                    or self.buffered):
+                writer = csv.writer(outfile, lineterminator='\n')
+                chunks = utils.read_occurrence_chunks(infiles[0],
+                    self.chunk_size, self.buffered)
+                self.sample_in_chunks(chunks, sample, metadata, writer)
+                return
             lines = [line.split(',') for line in infiles[0].read().splitlines()]
+            if not lines:
+                # No occurrences are left to sample, for instance when an
+                # incremental run finds no new species keys.
+                return
             species_keys, x, y = zip(*lines)
             x = [float(i) for i in x]
             y = [float(i) for i in y]
             xy = list(zip(x,y))
-            indexes = list(range(1, stacked.count + 1))
+            self.metrics.add('rows_in', len(xy))
+            self.metrics.add('rows_out', len(xy))
             samples = stacked.sample(xy, indexes)
-            col_names = ['BIO' + str(i) for i in indexes]
-            header = ['Species Key'] + col_names
-            outfile.write(','.join(header) + '\n')
             for i, sample in enumerate(samples):
-                message = 'Progress: {0:.0%}'.format(i / len(species_keys))
-                self.set_status_message(message)
-                if i % 1000 == 0: print(message)
+                self.progress.update('Progress: {0:.0%}', i / len(species_keys))
                 sample[sample == nodata] = np.NaN
                 cleaned = [str(s) for s in list(sample.round(3))]
                 data = [species_keys[i]] + cleaned
                 outfile.write(','.join(data) + '\n')
+
+    def merge_shards(self):
+        # Yields a SampleShard task for each shard as a dynamic dependency and
+        # appends their outputs in order of shard.
+        if self.cube or self.buffered:
+            raise Exception('--shard-size cannot be combined with --cube or '
+                            '--buffered.')
+        partition = self.input()[-1]
+        with partition.open('r') as infile:
+            shards = [line.split(',')[:2] for line
+                      in infile.read().splitlines()]
+        sampled = yield [self.for_query(SampleShard,
+            shard_size=self.shard_size, shard_row=int(shard_row),
+            shard_col=int(shard_col), chunk_size=self.chunk_size,
+            thin=self.thin)
+            for shard_row, shard_col in shards]
+        file_format = Intermediates().file_format
+        with rasterio.open(self.input()[1].path) as stacked:
+            col_names = ['BIO' + str(i) for i in range(1, stacked.count + 1)]
+        with ExitStack() as stack:
+            outfile = stack.enter_context(self.output().open('w'))
+            if file_format == 'parquet':
+                outfile = stack.enter_context(utils.pq.ParquetWriter(outfile,
+                    utils.climate_schema(col_names)))
+            else:
+                outfile.write(','.join(['Species Key'] + col_names) + '\n')
+            for i, target in enumerate(sampled):
+                self.progress.update('Progress: {0:.0%}', i / len(sampled))
+                utils.append_part_file(target.path, outfile, file_format)
+
+    def buffered_sampler(self, sample, metadata):
+        # Returns a function that samples points with buffers of the given
+        # radii from the summed-area tables, falling back on 'sample'.
+        sums_target, counts_target, info_target = (
+            BuildSummedAreaTables().output())
+        with info_target.open('r') as info_file:
+            info = pickle.load(info_file)
+        sums, counts = utils.open_summed_area_tables(sums_target.path,
+            counts_target.path, info, metadata)
+        return functools.partial(utils.sample_buffered, sums, counts, info,
+            sample)
+
+    def sample_in_chunks(self, chunks, sample, metadata, writer):
+        # Samples each chunk of occurrences with a single vectorized lookup and
+        # writes it out in bulk, either as CSV rows or as a Parquet row group.
+        # The CSV output is identical to the point by point loop above, unless
+        # a scaled climate cube is sampled, or the occurrences are thinned or
+        # buffered.
+        nodata = metadata['nodata']
+        raster = [metadata['transform'], metadata['width'], metadata['height']]
+        thinner = utils.CellThinner(metadata['width'], metadata['height'])
+        sampled = 0
+        for species_keys, x, y, *radius in chunks:
+            self.metrics.add('rows_in', len(species_keys))
+            if self.dedupe_cells or self.thin:
+                cells = utils.cell_indices(*raster, x, y)
+            if self.thin:
+                keep = thinner.keep(species_keys, cells)
+                species_keys, x, y = species_keys[keep], x[keep], y[keep]
+                cells = cells[keep]
+                radius = [r[keep] for r in radius]
+            if self.buffered:
+                samples = sample(x, y, *radius)
+            elif self.dedupe_cells:
+                samples = utils.sample_unique_cells(sample, cells, x, y)
+            else:
+                samples = sample(x, y)
+            utils.write_climate_samples(writer, species_keys, samples, nodata,
+                Intermediates().parquet)
+            sampled += len(species_keys)
+            self.metrics.add('rows_out', len(species_keys))
+            self.progress.update('Progress: {} records sampled', sampled)
         
         
-class AggregateClimateData(luigi.Task):
+class AggregateClimateData(QueryTask):
 
     # This task groups the species keys and aggregates the bioclimatic variables
     # based on their mean.
 
+    # With --streaming, the sampled values are read in chunks of 'chunk_size'
+    # records and the means are accumulated per species, so that the whole
+    # table never has to fit in memory.
+    streaming = luigi.BoolParameter(default=False)
+    chunk_size = luigi.IntParameter(default=1000000)
+
     def requires(self):
-        return SampleRasterData()
+        return self.for_query(SampleRasterData)
     
     def output(self):
-        return luigi.LocalTarget('data/aggregated-occurrences.txt')
+        return Intermediates().target(
+            'aggregated-occurrences' + self.requires().variant(),
+            self.query_dir)
     
     def run(self):
         with ExitStack() as stack:
             infile = stack.enter_context(self.input().open('r'))
             outfile = stack.enter_context(self.output().open('w'))
-            df = pd.read_csv(infile)
-            grouped = df.groupby('Species Key')
-            aggregated = grouped.mean().round(3)
-            aggregated.to_csv(outfile)
+            if self.streaming:
+                aggregated = self.aggregate_in_chunks(infile)
+            elif Intermediates().parquet:
+                df = pd.read_parquet(infile)
+                aggregated = df.groupby('Species Key').mean().round(3)
+            else:
+                df = pd.read_csv(infile)
+                grouped = df.groupby('Species Key')
+                aggregated = grouped.mean().round(3)
+            if not self.streaming:
+                self.metrics.add('rows_in', len(df))
+            if SpeciesStore().enabled:
+                aggregated = self.merge_store(aggregated)
+            manifest = Incremental().load_manifest(self)
+            if manifest:
+                aggregated = self.merge_baseline(aggregated, manifest)
+            self.metrics.add('rows_out', len(aggregated))
+            if Intermediates().parquet:
+                aggregated = aggregated.astype(np.float32)
+                aggregated.reset_index().to_parquet(outfile, index=False)
+            else:
+                aggregated.to_csv(outfile)
+
+    def merge_store(self, aggregated):
+        # Adds the new aggregates to the species store, and the stored
+        # aggregates of the species keys of this query that were not sampled
+        # in this run to the new ones.
+        species_store = SpeciesStore()
+        profile = species_store.profile(self)
+        target = self.for_query(RemoveDuplicateSpeciesKeys).output()
+        with target.open('r') as infile:
+            species_keys = infile.read().splitlines()
+        missing = [species_key for species_key in species_keys
+                   if int(species_key) not in aggregated.index]
+        with species_store.open() as store:
+            store.add_aggregates(profile, aggregated)
+            stored = store.aggregates(profile, missing)
+        print('{} of {} species keys were taken from the species store'.format(
+            len(stored), len(species_keys)))
+        return pd.concat([aggregated, stored]).sort_index()
+
+    def merge_baseline(self, aggregated, manifest):
+        # Adds the aggregates of the previous run for species that were not
+        # downloaded again in this one.
+        path = Incremental().baseline_file(self, manifest, 'aggregates')
+        if path.endswith('.parquet'):
+            baseline = pd.read_parquet(path).set_index('Species Key')
+        else:
+            baseline = pd.read_csv(path, index_col=0, float_precision='high')
+        baseline = baseline[~baseline.index.isin(aggregated.index)]
+        return pd.concat([baseline, aggregated]).sort_index()
+
+    def aggregate_in_chunks(self, infile):
+        # Accumulates the mean of each variable per species over chunks of
+        # sampled values and returns them as groupby().mean() would.
+        statistics = utils.SpeciesStatistics()
+        chunks = utils.read_climate_chunks(infile, self.chunk_size,
+            Intermediates().parquet)
+        records = 0
+        for chunk in chunks:
+            statistics.update(chunk)
+            records += len(chunk)
+            self.metrics.add('rows_in', len(chunk))
+            self.progress.update('Progress: {} records aggregated', records)
+        return statistics.means().round(3)
+
+
+class SummarizeClimateData(QueryTask):
+
+    # This task streams through the sampled bioclimatic variables and returns
+    # the count, mean, standard deviation, minimum and maximum of each variable
+    # for each species, with approximate quantiles if any are given.
+
+    quantiles = luigi.ListParameter(default=[])
+    chunk_size = luigi.IntParameter(default=1000000)
+
+    def requires(self):
+        return self.for_query(SampleRasterData)
+
+    def output(self):
+        return Intermediates().target(
+            'species-statistics' + self.requires().variant(),
+            self.query_dir)
+
+    def run(self):
+        with ExitStack() as stack:
+            infile = stack.enter_context(self.input().open('r'))
+            outfile = stack.enter_context(self.output().open('w'))
+            statistics = utils.SpeciesStatistics(self.quantiles)
+            chunks = utils.read_climate_chunks(infile, self.chunk_size,
+                Intermediates().parquet)
+            records = 0
+            for chunk in chunks:
+                statistics.update(chunk)
+                records += len(chunk)
+                self.metrics.add('rows_in', len(chunk))
+                self.progress.update('Progress: {} records summarized', records)
+            summary = statistics.summary().round(3)
+            self.metrics.add('rows_out', len(summary))
+            if Intermediates().parquet:
+                summary.reset_index().to_parquet(outfile, index=False)
+            else:
+                summary.to_csv(outfile)
             
             
-class JoinData(luigi.Task):
+class JoinData(QueryTask):
 
     # This task performs a series of joins on the list of UIDs, Taxonomy IDs and
     # aggregated species keys.
 
     def requires(self):
-        return [GetDocSummaries(), GBIFSpeciesMatch(), AggregateClimateData()]
+        return [self.for_query(GetDocSummaries),
+                self.for_query(GBIFSpeciesMatch),
+                self.for_query(AggregateClimateData)
+                ]
     
     def output(self):
-        return luigi.LocalTarget('data/joined-data.txt')
+        return Intermediates().target(
+            'joined-data' + self.for_query(SampleRasterData).variant(),
+            self.query_dir)
     
     def run(self):
         with ExitStack() as stack:
@@ -595,19 +1885,80 @@ class JoinData(luigi.Task):
 						names=['UID','Taxonomy ID'], index_col=0)
             df2 = pd.read_csv(infiles[1], header=None,
 						names=df2_column_names, index_col=0)
-            df3 = pd.read_csv(infiles[2], index_col=0, float_precision='high')
+            if Intermediates().parquet:
+                df3 = pd.read_parquet(infiles[2]).set_index('Species Key')
+            else:
+                df3 = pd.read_csv(infiles[2], index_col=0,
+                    float_precision='high')
             first_join = df1.join(df2, on='Taxonomy ID', how='inner')
             second_join = first_join.join(df3, on='Species Key', how='inner')
-            second_join.to_csv(outfile)
+            self.metrics.add('rows_in', len(df1))
+            self.metrics.add('rows_out', len(second_join))
+            if Intermediates().parquet:
+                second_join.reset_index().to_parquet(outfile, index=False)
+            else:
+                second_join.to_csv(outfile)
             
             
-class RunAllTasks(luigi.WrapperTask):
+class RecordRunManifest(QueryTask):
+
+    # This task copies the species matches and climate aggregates of this run
+    # into the baseline directory and records the UIDs, Taxonomy IDs and
+    # species keys it covered in a manifest, which the next incremental run
+    # is compared against.
+
+    def requires(self):
+        return [self.for_query(GetDocSummaries),
+                self.for_query(GBIFSpeciesMatch),
+                self.for_query(RemoveDuplicateSpeciesKeys),
+                self.for_query(AggregateClimateData)
+                ]
+
+    def output(self):
+        return self.query_target('run-manifest.json')
+
+    def run(self):
+        incremental = Incremental()
+        baseline_dir = incremental.directory(self)
+        os.makedirs(baseline_dir, exist_ok=True)
+        with ExitStack() as stack:
+            infiles = [stack.enter_context(f.open('r'))
+                       for f in self.input()[:3]]
+            outfile = stack.enter_context(self.output().open('w'))
+            lines = [line.split(',') for line in infiles[0].read().splitlines()]
+            species_keys = set(infiles[2].read().splitlines())
+            previous = incremental.load_manifest(self)
+            if previous:
+                # Keys downloaded by earlier runs are still covered by the
+                # merged aggregates.
+                species_keys.update(previous['species_keys'])
+            files = {'matches': 'gbif-species-matches.txt',
+                     'aggregates': os.path.basename(self.input()[3].path)
+                     }
+            shutil.copyfile(self.input()[1].path,
+                os.path.join(baseline_dir, files['matches']))
+            shutil.copyfile(self.input()[3].path,
+                os.path.join(baseline_dir, files['aggregates']))
+            manifest = {'created': datetime.datetime.now().isoformat(),
+                        'uids': sorted(set(uid for uid, taxid in lines)),
+                        'taxids': sorted(set(taxid for uid, taxid in lines)),
+                        'species_keys': sorted(species_keys),
+                        'files': files
+                        }
+            json.dump(manifest, outfile)
+        # The manifest is replaced last so that it never refers to files
+        # that have not been copied.
+        shutil.copyfile(self.output().path, incremental.manifest_path(self))
+
+
+class RunAllTasks(QueryTask, luigi.WrapperTask):
     
     # This dummy tasks invokes all upstream tasks.
     
     def requires(self):
-        yield GetDOIs()
-        yield JoinData()
+        yield self.for_query(GetDOIs)
+        yield self.for_query(JoinData)
+        yield self.for_query(RecordRunManifest)
         
     
 if __name__ == '__main__':
@@ -0,0 +1,642 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the BASIL pipeline.
+
+This script stands up local stand-ins for the NCBI E-utilities and the GBIF
+API, generates a synthetic 19-band raster and synthetic Darwin Core occurrence
+archives, and runs each task from SearchDB through JoinData in turn. The wall
+and CPU time, throughput and peak memory of every task are taken from the
+telemetry the pipeline records, printed as a table and saved as JSON so that
+later runs can be compared against them. For example:
+
+    $ python benchmark.py --workdir bench --occurrences 1000000
+    $ python benchmark.py --workdir bench --set SampleRasterData.cube=true \
+          --baseline bench/benchmark-baseline.json
+
+Each task runs in a Luigi process of its own, so its peak memory is not
+inflated by the tasks before it. Generated data is kept in the 'mock'
+directory of the working directory and reused while the generator settings
+are unchanged.
+"""
+import argparse
+import http.server
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import numpy as np
+import rasterio
+import utils
+from concurrent.futures import ProcessPoolExecutor
+from rasterio.transform import from_origin
+from xml.sax.saxutils import escape
+from zipfile import ZipFile, ZIP_DEFLATED
+
+# The tasks that JoinData depends on, in the order they are run.
+STAGES = ['SearchDB',
+          'GetDocSummaries',
+          'RemoveDuplicateTaxIDs',
+          'PostTaxIDs',
+          'GetTaxonomySummaries',
+          'GBIFSpeciesMatch',
+          'RemoveDuplicateSpeciesKeys',
+          'PostUsageKeys',
+          'GetDownloadLinks',
+          'DownloadOccurrences',
+          'GetRasterMetadata',
+          'StackRasterData',
+          'ConsolidateAndFilterOccurrences',
+          'SampleRasterData',
+          'AggregateClimateData',
+          'JoinData'
+          ]
+
+# Columns of a GBIF SIMPLE_CSV occurrence download. The pipeline reads the
+# latitude, longitude, coordinate uncertainty and species key by position.
+OCCURRENCE_COLUMNS = ['gbifID', 'datasetKey', 'occurrenceID', 'kingdom',
+    'phylum', 'class', 'order', 'family', 'genus', 'species',
+    'infraspecificEpithet', 'taxonRank', 'scientificName', 'countryCode',
+    'locality', 'publishingOrgKey', 'decimalLatitude', 'decimalLongitude',
+    'coordinateUncertaintyInMeters', 'coordinatePrecision', 'elevation',
+    'elevationAccuracy', 'depth', 'depthAccuracy', 'eventDate', 'day',
+    'month', 'year', 'taxonKey', 'speciesKey', 'basisOfRecord',
+    'institutionCode', 'collectionCode', 'catalogNumber', 'recordNumber',
+    'identifiedBy', 'dateIdentified', 'license', 'rightsHolder',
+    'recordedBy', 'typeStatus', 'establishmentMeans', 'lastInterpreted',
+    'mediaType', 'issue']
+
+FIRST_TAXID = 1000
+FIRST_SPECIES_KEY = 5000000
+RASTER_NODATA = -3.4e+38
+
+
+def taxon_name(taxid):
+    # Returns the scientific name the mock Taxonomy database gives 'taxid'.
+    return 'Synthetica{} taxon{}'.format(taxid // 10, taxid)
+
+def species_key(taxid, species):
+    # Returns the GBIF species key that the name of 'taxid' matches. Several
+    # taxa match each species, as synonyms and subspecies do.
+    return FIRST_SPECIES_KEY + (taxid - FIRST_TAXID) % species
+
+def write_raster(raster_dir, width, height, seed):
+    # Writes 19 single-band float32 GeoTIFFs covering the globe, named and
+    # numbered like the WorldClim bioclimatic variables. Each band is a smooth
+    # field with noise, and the cells outside a few continents are nodata.
+    os.makedirs(raster_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    transform = from_origin(-180, 90, 360 / width, 180 / height)
+    lon = np.linspace(-180, 180, width, endpoint=False) + 180 / width
+    lat = np.linspace(90, -90, height, endpoint=False) - 90 / height
+    lon, lat = np.meshgrid(lon, lat)
+    land = np.zeros((height, width), dtype=bool)
+    for cx, cy, r in zip(rng.uniform(-150, 150, 6), rng.uniform(-50, 60, 6),
+                         rng.uniform(20, 45, 6)):
+        land |= (lon - cx) ** 2 + ((lat - cy) * 1.5) ** 2 < r ** 2
+    profile = {'driver':'GTiff', 'dtype':'float32', 'nodata':RASTER_NODATA,
+               'width':width, 'height':height, 'count':1, 'crs':'EPSG:4326',
+               'transform':transform}
+    for band in range(1, 20):
+        phase = rng.uniform(0, 2 * np.pi)
+        field = (np.cos(np.radians(lat)) * 30 * band
+                 + np.sin(np.radians(lon) * 2 + phase) * 5
+                 + rng.normal(0, 1, (height, width)))
+        field = np.where(land, field, RASTER_NODATA).astype(np.float32)
+        path = os.path.join(raster_dir,
+                            'wc2.0_bio_synthetic_{:02d}.tif'.format(band))
+        with rasterio.open(path, 'w', **profile) as dst:
+            dst.write(field, 1)
+
+def write_occurrences(path, member, rows, species, seed, first_id=0,
+                      duplicate_rate=0, chunk_size=1000000):
+    # Writes a zipped GBIF SIMPLE_CSV occurrence dataset of 'rows' records of
+    # 'species' species keys, numbered from 'first_id'. Each species is
+    # clustered around a centre of its own. About 5% of records have no
+    # coordinates and 5% have a coordinate uncertainty above the default
+    # limit, so that they are filtered out. A 'duplicate_rate' share of the
+    # records of each chunk repeat an earlier record of the chunk, gbifID
+    # included, and the number of such copies is returned. Records are
+    # generated in chunks so that datasets of 100M rows or more can be
+    # written in constant memory.
+    duplicates = 0
+    rng = np.random.default_rng(seed)
+    centres = rng.uniform([-150, -50], [150, 60], (species, 2))
+    template = ('{}\t' + '\t'.join(['synthetic'] * 15) + '\t{}\t{}\t{}\t'
+                + '\t'.join([''] * 9) + '\t{}\t{}\t'
+                + '\t'.join(['HUMAN_OBSERVATION'] + [''] * 14) + '\n')
+    with ZipFile(path, 'w', compression=ZIP_DEFLATED, compresslevel=1) as z:
+        with z.open(member, 'w', force_zip64=True) as binary:
+            text = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+            text.write('\t'.join(OCCURRENCE_COLUMNS) + '\n')
+            for start in range(0, rows, chunk_size):
+                n = min(chunk_size, rows - start)
+                species_index = rng.integers(0, species, n)
+                x = centres[species_index, 0] + rng.normal(0, 8, n)
+                y = centres[species_index, 1] + rng.normal(0, 8, n)
+                x = ['%.5f' % v for v in np.clip(x, -179.99, 179.99).tolist()]
+                y = ['%.5f' % v for v in np.clip(y, -89.99, 89.99).tolist()]
+                for i in np.flatnonzero(rng.random(n) < 0.05).tolist():
+                    x[i] = y[i] = ''
+                uncertainty = rng.exponential(2000, n).astype(int)
+                uncertainty[rng.random(n) < 0.05] = 50000
+                uncertainty = [str(u) for u in uncertainty.tolist()]
+                for i in np.flatnonzero(rng.random(n) < 0.3).tolist():
+                    uncertainty[i] = ''
+                keys = (species_index + FIRST_SPECIES_KEY).tolist()
+                ids = list(range(first_id + start, first_id + start + n))
+                copies = min(int(round(n * duplicate_rate)), n - 1)
+                if copies > 0:
+                    # Copying in row order lets a copy be copied in turn,
+                    # which still adds one duplicate per copied row.
+                    rows_copied = np.sort(rng.choice(np.arange(1, n), copies,
+                                                     replace=False))
+                    sources = (rng.random(copies) * rows_copied).astype(int)
+                    for i, j in zip(rows_copied.tolist(), sources.tolist()):
+                        ids[i], x[i], y[i] = ids[j], x[j], y[j]
+                        uncertainty[i], keys[i] = uncertainty[j], keys[j]
+                    duplicates += copies
+                text.write(''.join(map(template.format, ids, y, x,
+                                       uncertainty, keys, keys)))
+            text.flush()
+            text.detach()
+    return duplicates
+
+def generate_data(mock_dir, raster_dir, settings):
+    # Generates the raster and the occurrence archives for 'settings', unless
+    # those in 'mock_dir' were generated with the same settings, and returns
+    # the paths of the archives.
+    os.makedirs(mock_dir, exist_ok=True)
+    settings_path = os.path.join(mock_dir, 'settings.json')
+    downloads = len(utils.pack_species_keys(list(range(settings['species'])),
+                                            300))
+    paths = [os.path.join(mock_dir, '{:07d}.zip'.format(i))
+             for i in range(downloads)]
+    if os.path.exists(settings_path):
+        with open(settings_path, 'r') as f:
+            if json.load(f) == settings and os.path.exists(raster_dir):
+                return paths
+    print('Generating a {}x{} raster and {} occurrences in {} archives'.format(
+        settings['raster_width'], settings['raster_height'],
+        settings['occurrences'], downloads))
+    if os.path.exists(raster_dir):
+        shutil.rmtree(raster_dir)
+    write_raster(raster_dir, settings['raster_width'],
+                 settings['raster_height'], settings['seed'])
+    rows = [settings['occurrences'] // downloads] * downloads
+    rows[0] += settings['occurrences'] % downloads
+    # Each archive gets gbifIDs of its own, as downloads of disjoint species
+    # do, so that the only duplicates are the ones written on purpose.
+    first_ids = np.cumsum([0] + rows[:-1]).tolist()
+    duplicates = 0
+    for i, (path, n, first_id) in enumerate(zip(paths, rows, first_ids)):
+        duplicates += write_occurrences(path, '{:07d}.csv'.format(i), n,
+            settings['species'], settings['seed'] + i, first_id,
+            settings['duplicate_rate'])
+    print('Wrote {} duplicate records'.format(duplicates))
+    with open(settings_path, 'w') as f:
+        json.dump(settings, f)
+    return paths
+
+
+class RateLimit:
+    # This class decides whether a mock service accepts a request, allowing
+    # 'rate' requests per second on average with bursts of up to 'rate'. A
+    # rate of 0 accepts every request.
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens
+                              + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class MockServer(http.server.ThreadingHTTPServer):
+    # This class serves stand-ins for the Entrez ESearch, ESummary, EPost,
+    # EFetch and ELink utilities under /entrez/eutils/ and for the GBIF
+    # species/match and occurrence download endpoints under /gbif/v1/. Every
+    # response is delayed by 'latency' seconds, and requests beyond the rate
+    # limit of a service are refused with 429 and a Retry-After header, as
+    # NCBI does. A download is prepared after 'prepare_polls' status polls,
+    # counting each listing of the user's downloads as a poll of every one,
+    # and the i-th download request is served the i-th archive.
+    daemon_threads = True
+
+    def __init__(self, settings, archives):
+        super().__init__(('127.0.0.1', 0), MockHandler)
+        self.settings = settings
+        self.archives = archives
+        self.limits = {'entrez': RateLimit(settings['entrez_rate']),
+                       'gbif': RateLimit(settings['gbif_rate'])}
+        self.posted = {}
+        self.downloads = {}
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}/'.format(*self.server_address)
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, code, body, content_type, headers=()):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if method == 'POST':
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length).decode('utf-8')
+            content_type = self.headers.get('Content-Type', '')
+            if content_type.startswith('application/json'):
+                params['json'] = json.loads(body)
+            else:
+                params.update(urllib.parse.parse_qsl(body))
+                params['id'] = [v for k, v in urllib.parse.parse_qsl(body)
+                                if k == 'id']
+        service, _, endpoint = url.path.strip('/').partition('/')
+        server = self.server
+        if service not in server.limits:
+            return self.respond(404, 'Not found', 'text/plain')
+        time.sleep(server.settings['latency'])
+        if not server.limits[service].allow():
+            return self.respond(429, 'Too Many Requests', 'text/plain',
+                                [('Retry-After', '1')])
+        handler = getattr(self, service)
+        handler(method, endpoint, params)
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def entrez(self, method, endpoint, params):
+        settings = self.server.settings
+        name = endpoint.rsplit('/', 1)[-1]
+        if name == 'esearch.fcgi':
+            result = {'count': str(settings['uids']), 'retmax': '0',
+                      'retstart': '0', 'querykey': '1',
+                      'webenv': 'MOCK_WEBENV_' + params['db'], 'idlist': []}
+            return self.respond(200, json.dumps({'esearchresult': result}),
+                                'application/json')
+        if name == 'epost.fcgi':
+            with self.server.lock:
+                webenv = 'MOCK_EPOST_{}'.format(len(self.server.posted))
+                ids = ','.join(params['id']).split(',')
+                self.server.posted[webenv] = ids
+            body = ('<?xml version="1.0" encoding="UTF-8" ?>\n<ePostResult>'
+                    '<QueryKey>1</QueryKey><WebEnv>{}</WebEnv>'
+                    '</ePostResult>'.format(webenv))
+            return self.respond(200, body, 'text/xml')
+        if name == 'elink.fcgi':
+            link_sets = ''.join(
+                '<LinkSet><DbFrom>protein</DbFrom><IdList><Id>{}</Id></IdList>'
+                '<LinkSetDb><DbTo>taxonomy</DbTo><Link><Id>{}</Id></Link>'
+                '</LinkSetDb></LinkSet>'.format(uid, self.taxid(uid))
+                for uid in params['id'])
+            return self.respond(200, '<eLinkResult>{}</eLinkResult>'.format(
+                link_sets), 'text/xml')
+        ids = self.history(params)
+        start = int(params['retstart'])
+        ids = ids[start:start + int(params['retmax'])]
+        if name == 'efetch.fcgi':
+            return self.respond(200, '\n'.join(ids) + '\n', 'text/plain')
+        if name != 'esummary.fcgi':
+            return self.respond(404, 'Not found', 'text/plain')
+        if params['db'] == 'taxonomy':
+            summaries = [{'uid': taxid, 'taxid': int(taxid),
+                          'scientificname': taxon_name(int(taxid)),
+                          'rank': 'species', 'division': 'eudicots'}
+                         for taxid in ids]
+        else:
+            summaries = [{'uid': uid, 'taxid': self.taxid(uid),
+                          'caption': 'MOCK' + uid, 'title': 'NBS-LRR protein',
+                          'slen': 900} for uid in ids]
+        if params.get('retmode') == 'xml':
+            body = ''.join('<DocumentSummary uid="{}">{}</DocumentSummary>'
+                .format(summary['uid'], ''.join(
+                    '<{0}>{1}</{0}>'.format(utils.ESUMMARY_XML_FIELDS.get(k, k),
+                                            escape(str(v)))
+                    for k, v in summary.items() if k != 'uid'))
+                for summary in summaries)
+            body = ('<?xml version="1.0" encoding="UTF-8" ?>\n<eSummaryResult>'
+                    '<DocumentSummarySet status="OK">{}</DocumentSummarySet>'
+                    '</eSummaryResult>'.format(body))
+            return self.respond(200, body, 'text/xml')
+        result = {'uids': ids}
+        result.update((summary['uid'], summary) for summary in summaries)
+        return self.respond(200, json.dumps({'result': result}),
+                            'application/json; charset=UTF-8')
+
+    def history(self, params):
+        # Returns the UIDs stored on the mock History Server for a request.
+        if params['webenv'] in self.server.posted:
+            return self.server.posted[params['webenv']]
+        return [str(uid) for uid in range(1, self.server.settings['uids'] + 1)]
+
+    def taxid(self, uid):
+        return FIRST_TAXID + int(uid) % self.server.settings['taxa']
+
+    def gbif(self, method, endpoint, params):
+        settings = self.server.settings
+        if endpoint == 'v1/species/match':
+            taxid = int(re.search(r'(\d+)$', params['name']).group(1))
+            key = species_key(taxid, settings['species'])
+            result = {'usageKey': key, 'speciesKey': key,
+                      'scientificName': params['name'],
+                      'rank': 'SPECIES', 'status': 'ACCEPTED',
+                      'matchType': 'EXACT', 'confidence': 99,
+                      'kingdom': 'Plantae', 'phylum': 'Tracheophyta',
+                      'order': 'Order{}'.format(key % 7),
+                      'family': 'Family{}'.format(key % 31),
+                      'genus': 'Genus{}'.format(key % 97),
+                      'species': 'Genus{} species{}'.format(key % 97, key)}
+            return self.respond(200, json.dumps(result), 'application/json')
+        if endpoint == 'v1/occurrence/download/request' and method == 'POST':
+            with self.server.lock:
+                download_id = '{:07d}-{:012d}'.format(
+                    len(self.server.downloads), 0)
+                self.server.downloads[download_id] = 0
+            return self.respond(201, download_id, 'text/plain')
+        match = re.match(r'v1/occurrence/download/request/([\w-]+)\.zip$',
+                         endpoint)
+        if match:
+            return self.archive(match.group(1))
+        match = re.match(r'v1/occurrence/download/user/([^/]+)$', endpoint)
+        if match:
+            # Listing the downloads counts as a poll of each one being
+            # prepared, so that downloads that are never polled on their own
+            # are still prepared in time.
+            with self.server.lock:
+                downloads = self.server.downloads
+                running = []
+                for download_id in downloads:
+                    if downloads[download_id] <= settings['prepare_polls']:
+                        downloads[download_id] += 1
+                    if downloads[download_id] <= settings['prepare_polls']:
+                        running.append(download_id)
+            result = {'offset': 0, 'limit': int(params.get('limit', 20)),
+                      'endOfRecords': True, 'count': len(running),
+                      'results': [{'key': download_id, 'status': 'PREPARING'}
+                                  for download_id in running]}
+            return self.respond(200, json.dumps(result), 'application/json')
+        match = re.match(r'v1/occurrence/download/([\w-]+)$', endpoint)
+        if match and match.group(1) in self.server.downloads:
+            download_id = match.group(1)
+            with self.server.lock:
+                self.server.downloads[download_id] += 1
+                polls = self.server.downloads[download_id]
+            ready = polls > settings['prepare_polls']
+            link = '{}gbif/v1/occurrence/download/request/{}.zip'.format(
+                self.server.base_url, download_id)
+            result = {'key': download_id,
+                      'status': 'SUCCEEDED' if ready else 'PREPARING',
+                      'downloadLink': link,
+                      'doi': '10.0000/mock.' + download_id}
+            return self.respond(200, json.dumps(result), 'application/json')
+        return self.respond(404, 'Not found', 'text/plain')
+
+    def archive(self, download_id):
+        # Serves the archive of a download, honouring Range requests so that
+        # interrupted downloads can be resumed.
+        archives = self.server.archives
+        path = archives[int(download_id.split('-')[0]) % len(archives)]
+        size = os.path.getsize(path)
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            if start >= size:
+                return self.respond(416, '', 'text/plain',
+                    [('Content-Range', 'bytes */{}'.format(size))])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+
+def write_config(path, base_url, overrides):
+    # Writes the Luigi configuration that points the pipeline at the mock
+    # server, makes failed tasks exit with a non-zero code and applies the
+    # 'Section.key=value' overrides given on the command line.
+    sections = {'Endpoints': {'entrez': base_url + 'entrez/eutils/',
+                              'gbif': base_url + 'gbif/v1/'},
+                'retcode': {'already_running': 10, 'missing_data': 20,
+                            'not_run': 25, 'task_failed': 30,
+                            'scheduling_error': 35,
+                            'unhandled_exception': 40}}
+    for override in overrides:
+        key, _, value = override.partition('=')
+        section, _, option = key.rpartition('.')
+        sections.setdefault(section, {})[option] = value
+    with open(path, 'w') as f:
+        for section, options in sections.items():
+            f.write('[{}]\n'.format(section))
+            for option, value in options.items():
+                f.write('{}={}\n'.format(option, value))
+            f.write('\n')
+
+def run_stages(workdir, config_path, stages):
+    # Runs each stage in a Luigi process of its own and returns the wall time
+    # of each process. An exception is raised if a stage fails.
+    env = dict(os.environ, LUIGI_CONFIG_PATH=os.path.abspath(config_path),
+               PYTHONPATH=os.pathsep.join(filter(None,
+                   [os.path.dirname(os.path.abspath(__file__)),
+                    os.environ.get('PYTHONPATH')])))
+    times = {}
+    for stage in stages:
+        print('Running', stage)
+        start = time.monotonic()
+        completed = subprocess.run([sys.executable, '-m', 'luigi', '--module',
+            'basil-pipeline', stage, '--local-scheduler', '--log-level',
+            'WARNING'], cwd=workdir, env=env)
+        times[stage] = time.monotonic() - start
+        if completed.returncode != 0:
+            raise Exception('{} failed with exit code {}'.format(stage,
+                            completed.returncode))
+    return times
+
+def summarize(report, process_times):
+    # Derives the throughput of each stage in the run report of the
+    # pipeline: records, requests and network megabytes per second of wall
+    # time, and peak memory in megabytes.
+    results = []
+    for stage in report['stages']:
+        wall = stage['wall_seconds']
+        counters = stage['counters']
+        records = counters.get('rows_out', counters.get('rows_in'))
+        def rate(value):
+            return value / wall if value and wall > 0 else None
+        peak = stage['peak_rss_bytes']
+        results.append({'task': stage['task'],
+                        'task_id': stage['task_id'],
+                        'status': stage['status'],
+                        'wall_seconds': wall,
+                        'process_seconds': process_times.get(stage['task']),
+                        'cpu_seconds': stage['cpu_seconds'],
+                        'records': records,
+                        'records_per_second': rate(records),
+                        'requests': counters.get('http_requests', 0),
+                        'requests_per_second':
+                            rate(counters.get('http_requests')),
+                        'retries': counters.get('http_retries', 0),
+                        'network_mb_per_second':
+                            rate(counters.get('http_bytes', 0) / 1e6),
+                        'sleep_seconds':
+                            counters.get('rate_limit_sleep_seconds', 0)
+                            + counters.get('poll_sleep_seconds', 0),
+                        'peak_memory_mb': peak / 1e6 if peak else None})
+    return results
+
+def print_results(results, baseline):
+    # Prints the results as a table, with the speedup of each task over the
+    # baseline run if one is given.
+    previous = {}
+    for stage in baseline or []:
+        previous.setdefault(stage['task'], stage['wall_seconds'])
+    def cell(value, digits=1):
+        if value is None:
+            return '-'
+        return '{:.{}f}'.format(value, digits)
+    header = ['Task', 'Wall s', 'CPU s', 'Records/s', 'Req/s', 'Net MB/s',
+              'Sleep s', 'Peak MB', 'Speedup']
+    rows = []
+    for stage in results:
+        speedup = None
+        if stage['task'] in previous and stage['wall_seconds'] > 0:
+            speedup = previous[stage['task']] / stage['wall_seconds']
+        rows.append([stage['task'], cell(stage['wall_seconds'], 2),
+                     cell(stage['cpu_seconds'], 2),
+                     cell(stage['records_per_second'], 0),
+                     cell(stage['requests_per_second']),
+                     cell(stage['network_mb_per_second']),
+                     cell(stage['sleep_seconds']),
+                     cell(stage['peak_memory_mb'], 0),
+                     cell(speedup, 2) + ('x' if speedup else '')])
+    widths = [max(len(row[i]) for row in [header] + rows)
+              for i in range(len(header))]
+    for row in [header] + rows:
+        print('  '.join([row[0].ljust(widths[0])]
+                        + [c.rjust(w) for c, w in zip(row[1:], widths[1:])]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workdir', default='benchmark',
+        help='directory the pipeline is run in (default: %(default)s)')
+    parser.add_argument('--uids', type=int, default=20000,
+        help='protein UIDs returned by ESearch (default: %(default)s)')
+    parser.add_argument('--taxa', type=int, default=2000,
+        help='distinct Taxonomy IDs of the UIDs (default: %(default)s)')
+    parser.add_argument('--species', type=int, default=1000,
+        help='distinct GBIF species keys of the taxa (default: %(default)s)')
+    parser.add_argument('--occurrences', type=int, default=1000000,
+        help='occurrence records across all downloads '
+             '(default: %(default)s)')
+    parser.add_argument('--duplicate-rate', type=float, default=0.01,
+        help='share of the occurrence records of each download that repeat '
+             'an earlier record of it (default: %(default)s)')
+    parser.add_argument('--raster-width', type=int, default=720)
+    parser.add_argument('--raster-height', type=int, default=360)
+    parser.add_argument('--latency', type=float, default=0.05,
+        help='seconds added to every API response (default: %(default)s)')
+    parser.add_argument('--entrez-rate', type=float, default=10,
+        help='Entrez requests accepted per second, or 0 for no limit '
+             '(default: %(default)s)')
+    parser.add_argument('--gbif-rate', type=float, default=0,
+        help='GBIF requests accepted per second, or 0 for no limit '
+             '(default: %(default)s)')
+    parser.add_argument('--prepare-polls', type=int, default=0,
+        help='status polls before a download is ready (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--set', action='append', default=[],
+        metavar='SECTION.KEY=VALUE', help='Luigi configuration override, '
+        'e.g. GetDocSummaries.retmode=xml; may be repeated')
+    parser.add_argument('--baseline',
+        help='results of an earlier run to compare against')
+    parser.add_argument('--output',
+        help='where to save the results (default: WORKDIR/benchmark.json)')
+    args = parser.parse_args()
+
+    settings = {'uids': args.uids, 'taxa': args.taxa,
+                'species': args.species, 'occurrences': args.occurrences,
+                'duplicate_rate': args.duplicate_rate,
+                'raster_width': args.raster_width,
+                'raster_height': args.raster_height, 'seed': args.seed}
+    # The data is generated in a process of its own because Linux carries
+    # the peak memory of this process over to the stages it starts.
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        archives = executor.submit(generate_data,
+            os.path.join(args.workdir, 'mock'),
+            os.path.join(args.workdir, 'raster'), settings).result()
+    data_dir = os.path.join(args.workdir, 'data')
+    if os.path.exists(data_dir):
+        shutil.rmtree(data_dir)
+    os.makedirs(data_dir)
+    server = MockServer(dict(settings, latency=args.latency,
+                             entrez_rate=args.entrez_rate,
+                             gbif_rate=args.gbif_rate,
+                             prepare_polls=args.prepare_polls), archives)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        config_path = os.path.join(args.workdir, 'luigi.cfg')
+        write_config(config_path, server.base_url, args.set)
+        process_times = run_stages(args.workdir, config_path, STAGES)
+    finally:
+        server.shutdown()
+    with open(os.path.join(data_dir, 'run-report.json'), 'r') as f:
+        report = json.load(f)
+    results = summarize(report, process_times)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['stages']
+    print_results(results, baseline)
+    output = args.output or os.path.join(args.workdir, 'benchmark.json')
+    with open(output, 'w') as f:
+        json.dump({'settings': vars(args), 'stages': results}, f, indent=2)
+    print('Results saved to', output)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,9 +4,811 @@ Created on Wed May 22 20:30:41 2019
 
 @author: benja
 """
+import bisect
+import csv
+import functools
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import math
+import os
+import re
+import numpy as np
+import pandas as pd
 import requests
 import shutil
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+import urllib3
+import zlib
+import xml.etree.ElementTree as ET
+from collections import Counter, deque
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+import rasterio
+from rasterio.windows import Window
 from zipfile import ZipFile
+try:
+    import resource
+except ImportError: # Not available on Windows.
+    resource = None
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # Only needed for Parquet intermediates.
+    pa = pq = None
+
+
+class TokenBucket:
+    # This class limits the rate at which requests are sent to a web service.
+    # A token is added to the bucket every 1/rate seconds, up to 'capacity'
+    # tokens, and each request must take one before it is sent. Unlike a fixed
+    # sleep after each call, the time spent waiting for a response counts
+    # towards the budget. The bucket is shared safely between threads.
+
+    def __init__(self, rate, capacity=1, metrics=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.metrics = metrics
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.updated
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            # A negative balance is the time this caller owes the bucket.
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+            if self.metrics is not None:
+                self.metrics.add('rate_limit_sleep_seconds', delay)
+
+
+# Upper bounds, in seconds, of the buckets of the HTTP latency histogram.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class StageMetrics:
+    # This class records the performance of one run of a pipeline stage: its
+    # wall and CPU time, the HTTP requests sent by its sessions, the time it
+    # spent sleeping on rate limits and polls, and any other named counters
+    # such as the rows it read and wrote. CPU time includes that of child
+    # processes which have exited, such as the workers of a process pool.
+    # Counters may be updated from several threads at once.
+
+    def __init__(self):
+        self.started = time.time()
+        self.wall_start = time.monotonic()
+        self.cpu_start = self.cpu_time()
+        self.counters = Counter()
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def cpu_time():
+        times = os.times()
+        return (times.user + times.system + times.children_user
+                + times.children_system)
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe_response(self, response, *args, **kwargs):
+        # A requests response hook. The latency is the time until the headers
+        # arrived, and the bytes are those reported by Content-Length, which
+        # is the size on the wire for a compressed response.
+        seconds = response.elapsed.total_seconds()
+        retry = getattr(response.raw, 'retries', None)
+        retries = len(retry.history) if retry is not None else 0
+        size = response.headers.get('Content-Length')
+        with self.lock:
+            self.counters['http_requests'] += 1
+            self.counters['http_retries'] += retries
+            if size is not None and size.isdigit():
+                self.counters['http_bytes'] += int(size)
+            if response.status_code >= 400:
+                self.counters['http_errors'] += 1
+            bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+            self.latency_counts[bucket] += 1
+            self.latency_sum += seconds
+
+    def summary(self):
+        with self.lock:
+            return {'started': self.started,
+                    'wall_seconds': time.monotonic() - self.wall_start,
+                    'cpu_seconds': self.cpu_time() - self.cpu_start,
+                    'peak_rss_bytes': peak_rss(),
+                    'counters': dict(self.counters),
+                    'http_latency': {'buckets': list(LATENCY_BUCKETS),
+                                     'counts': list(self.latency_counts),
+                                     'sum': self.latency_sum}}
+
+
+def peak_rss():
+    # This function returns the peak resident set size of this process in
+    # bytes, or None where the resource module is unavailable (Windows).
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Progress:
+    # This class reports progress messages from a loop through 'report' at
+    # most once every 'interval' seconds, so that a hot loop pays only for a
+    # clock read on most iterations. The message is 'template' formatted
+    # with 'value', and is only formatted when it is reported.
+
+    def __init__(self, report, interval):
+        self.report = report
+        self.interval = interval
+        self.last = None
+
+    def update(self, template, value):
+        now = time.monotonic()
+        if self.last is not None and now - self.last < self.interval:
+            return
+        self.last = now
+        self.report(template.format(value))
+
+
+def prometheus_text(stages):
+    # This function formats the summaries of pipeline stages, each with its
+    # 'task' family and 'task_id' added, in the Prometheus text exposition
+    # format for the node exporter's textfile collector.
+    lines = []
+    def header(name, kind, help_text):
+        lines.append('# HELP basil_{} {}'.format(name, help_text))
+        lines.append('# TYPE basil_{} {}'.format(name, kind))
+    def sample(name, labels, value):
+        label_text = ','.join('{}="{}"'.format(k, v) for k, v
+                              in labels.items())
+        lines.append('basil_{}{{{}}} {}'.format(name, label_text, value))
+    def metric(name, kind, help_text, samples):
+        header(name, kind, help_text)
+        for labels, value in samples:
+            sample(name, labels, value)
+    def labels(stage, **extra):
+        result = {'task':stage['task'], 'task_id':stage['task_id']}
+        result.update(extra)
+        return result
+    def counter(stage, name):
+        return stage['counters'].get(name, 0)
+    metric('stage_success', 'gauge', 'Whether the last run of the stage '
+           'succeeded.', [(labels(stage), int(stage['status'] == 'SUCCESS'))
+                          for stage in stages])
+    metric('stage_start_time_seconds', 'gauge', 'Start time of the stage.',
+           [(labels(stage), stage['started']) for stage in stages])
+    metric('stage_wall_seconds', 'gauge', 'Wall time of the stage.',
+           [(labels(stage), stage['wall_seconds']) for stage in stages])
+    metric('stage_cpu_seconds', 'gauge', 'CPU time of the stage.',
+           [(labels(stage), stage['cpu_seconds']) for stage in stages])
+    metric('stage_peak_rss_bytes', 'gauge', 'Peak resident set size of the '
+           'process when the stage finished.',
+           [(labels(stage), stage['peak_rss_bytes']) for stage in stages
+            if stage['peak_rss_bytes'] is not None])
+    metric('stage_sleep_seconds', 'gauge', 'Time the stage spent sleeping.',
+           [(labels(stage, reason=reason), counter(stage, name))
+            for stage in stages for reason, name
+            in [('rate_limit', 'rate_limit_sleep_seconds'),
+                ('poll', 'poll_sleep_seconds')]])
+    metric('stage_rows', 'gauge', 'Rows read and written by the stage.',
+           [(labels(stage, direction=direction), counter(stage, name))
+            for stage in stages for direction, name
+            in [('in', 'rows_in'), ('out', 'rows_out')]])
+    for name, help_text in [('requests', 'HTTP requests sent'),
+                            ('retries', 'HTTP requests retried'),
+                            ('errors', 'HTTP error responses'),
+                            ('bytes', 'HTTP response bytes')]:
+        metric('http_{}_total'.format(name), 'counter', help_text + '.',
+               [(labels(stage), counter(stage, 'http_' + name))
+                for stage in stages])
+    name = 'http_request_duration_seconds'
+    header(name, 'histogram', 'HTTP request latency.')
+    for stage in stages:
+        histogram = stage['http_latency']
+        bounds = [str(b) for b in histogram['buckets']] + ['+Inf']
+        cumulative = 0
+        for bound, count in zip(bounds, histogram['counts']):
+            cumulative += count
+            sample(name + '_bucket', labels(stage, le=bound), cumulative)
+        sample(name + '_sum', labels(stage), histogram['sum'])
+        sample(name + '_count', labels(stage), cumulative)
+    return '\n'.join(lines) + '\n'
+
+
+class NameMatchCache:
+    # This class stores the results of GBIF species/match requests in a local
+    # SQLite database keyed on the name, kingdom and strict flag of the
+    # request. Results older than 'ttl' seconds are treated as missing.
+
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS matches '
+            '(name TEXT, kingdom TEXT, strict TEXT, result TEXT, created REAL, '
+            'PRIMARY KEY (name, kingdom, strict))')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.connection.close()
+
+    def get(self, name, kingdom, strict):
+        row = self.connection.execute('SELECT result FROM matches WHERE '
+            'name = ? AND kingdom = ? AND strict = ? AND created >= ?',
+            (name, kingdom, strict, time.time() - self.ttl)).fetchone()
+        if row:
+            return json.loads(row[0])
+
+    def put(self, name, kingdom, strict, result):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO matches '
+                'VALUES (?, ?, ?, ?, ?)', (name, kingdom, strict,
+                json.dumps(result), time.time()))
+
+    def invalidate(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM matches')
+
+
+class ArtifactStore:
+    # This class stores the artifacts of species keys that every query can
+    # reuse in a local SQLite database: the kept occurrence archives that
+    # hold the occurrences of each species key, and the climate aggregates of
+    # each species key under each sampling 'profile'. Pipelines for several
+    # queries may read and add to the store at once, since SQLite lets only
+    # one of them write at a time and the others wait up to 'timeout'
+    # seconds.
+
+    # SQLite limits the number of variables in a statement.
+    max_variables = 500
+
+    def __init__(self, path, timeout=60):
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS archives '
+                '(species_key TEXT, path TEXT, created REAL, '
+                'PRIMARY KEY (species_key, path))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS aggregates '
+                '(profile TEXT, species_key TEXT, aggregate TEXT, '
+                'created REAL, PRIMARY KEY (profile, species_key))')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.connection.close()
+
+    def select(self, query, species_keys, *args):
+        # Runs 'query', in which '{}' stands for the placeholders of a batch
+        # of species keys followed by 'args', for each batch in turn.
+        species_keys = list(species_keys)
+        rows = []
+        for start in range(0, len(species_keys), self.max_variables):
+            batch = species_keys[start:start + self.max_variables]
+            placeholders = ','.join('?' * len(batch))
+            rows.extend(self.connection.execute(query.format(placeholders),
+                                                batch + list(args)))
+        return rows
+
+    def add_archive(self, species_keys, path):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO archives '
+                'VALUES (?, ?, ?)', [(str(species_key), path, time.time())
+                                     for species_key in species_keys])
+
+    def archives(self, species_keys):
+        # Returns the paths of the stored archives of each of 'species_keys',
+        # leaving out archives that have since been removed.
+        paths = {}
+        rows = self.select('SELECT species_key, path FROM archives WHERE '
+            'species_key IN ({})', species_keys)
+        for species_key, path in rows:
+            if os.path.exists(path):
+                paths.setdefault(species_key, []).append(path)
+        return paths
+
+    def add_aggregates(self, profile, aggregated):
+        # Stores the rows of a data frame of aggregates indexed by species key.
+        rows = [(profile, str(species_key), json.dumps(row), time.time())
+                for species_key, row
+                in zip(aggregated.index, aggregated.to_dict('records'))]
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO aggregates '
+                'VALUES (?, ?, ?, ?)', rows)
+
+    def aggregated_keys(self, profile, species_keys):
+        rows = self.select('SELECT species_key FROM aggregates WHERE '
+            'species_key IN ({}) AND profile = ?', species_keys, profile)
+        return set(species_key for species_key, in rows)
+
+    def aggregates(self, profile, species_keys):
+        # Returns the stored aggregates of 'species_keys' as a data frame
+        # indexed by integer species key, as AggregateClimateData writes them.
+        rows = self.select('SELECT species_key, aggregate FROM aggregates '
+            'WHERE species_key IN ({}) AND profile = ?', species_keys, profile)
+        index = pd.Index([int(species_key) for species_key, aggregate in rows],
+                         dtype=np.int64, name='Species Key')
+        return pd.DataFrame([json.loads(aggregate) for species_key, aggregate
+                             in rows], index=index)
+
+
+def query_namespace(search_term):
+    # This function returns the name of the directory that holds the outputs
+    # of a query: a readable slug of the search term followed by part of its
+    # SHA-1 digest, so that terms that differ only in case or punctuation, or
+    # share a long prefix, still get directories of their own.
+    slug = re.sub(r'[^a-z0-9]+', '-', search_term.lower()).strip('-')
+    digest = hashlib.sha1(search_term.encode('utf-8')).hexdigest()[:10]
+    return '{}-{}'.format(slug[:48].strip('-') or 'query', digest)
+
+
+class Journal:
+    # This class is an append-only checkpoint journal in which a task records
+    # the batches of work it has completed, one JSON record per line, so that
+    # a restarted task can skip them. The first line holds the 'context' the
+    # work depends on, such as the inputs of the task, and a journal written
+    # in a different context is started afresh. A line cut short by a crash
+    # is dropped.
+
+    def __init__(self, path, context):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        records = []
+        size = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+                    size += len(line)
+        if not records or records[0] != {'context': context}:
+            records = []
+            size = 0
+        self.records = records[1:]
+        self.file = open(path, 'ab')
+        self.file.truncate(size)
+        if not size:
+            self.append({'context': context})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+    def append(self, record):
+        self.file.write(json.dumps(record).encode('utf-8') + b'\n')
+        self.file.flush()
+
+    def discard(self):
+        # Removes the journal once the task has completed.
+        self.file.close()
+        os.remove(self.path)
+
+
+def request_key(request):
+    # This function returns a digest identifying a prepared request by its
+    # method, URL and body. Query and form parameters are sorted by name and
+    # the API key is left out, so that equivalent requests share a key.
+    url = urllib.parse.urlsplit(request.url)
+    def normalize(pairs):
+        pairs = [(k, v) for k, v in pairs if k != 'api_key']
+        return sorted(pairs, key=lambda pair: pair[0])
+    query = normalize(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+    body = request.body or b''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    content_type = request.headers.get('Content-Type', '')
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        form = urllib.parse.parse_qsl(body.decode('utf-8'),
+                                      keep_blank_values=True)
+        body = urllib.parse.urlencode(normalize(form)).encode('utf-8')
+    elif content_type.startswith('application/json'):
+        body = json.dumps(json.loads(body), sort_keys=True).encode('utf-8')
+    key = json.dumps([request.method, url.scheme, url.netloc.lower(),
+                      url.path, query])
+    return hashlib.sha256(key.encode('utf-8') + b'\0' + body).hexdigest()
+
+
+class ResponseStore:
+    # This class stores HTTP responses in a local SQLite database keyed on
+    # request_key(). Bodies are stored decoded and compressed with zlib. The
+    # store is shared safely between the threads of a session.
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses '
+            '(key TEXT PRIMARY KEY, url TEXT, status INTEGER, reason TEXT, '
+            'headers TEXT, body BLOB, created REAL)')
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT status, reason, headers, '
+                'body FROM responses WHERE key = ?', (key,)).fetchone()
+        if row:
+            status, reason, headers, body = row
+            return status, reason, json.loads(headers), zlib.decompress(body)
+
+    def put(self, key, url, status, reason, headers, body):
+        self.put_compressed(key, url, status, reason, headers,
+                            zlib.compress(body))
+
+    def put_compressed(self, key, url, status, reason, headers, compressed):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO responses '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', (key, url, status, reason,
+                json.dumps(headers), compressed, time.time()))
+
+
+class TeeReader(io.RawIOBase):
+    # This class reads the decoded body of a streamed urllib3 response and
+    # compresses a copy of it on the way, so that a response can be parsed as
+    # it streams in and still be stored. The compressed copy is passed to
+    # 'on_complete' once the body has been read to the end; a body that is
+    # not read to the end is not stored.
+
+    def __init__(self, raw, on_complete, chunk_size=65536):
+        self.raw = raw
+        self.on_complete = on_complete
+        self.blocks = raw.stream(chunk_size, decode_content=True)
+        self.pending = b''
+        self.compressor = zlib.compressobj()
+        self.compressed = []
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self.pending:
+            self.pending = next(self.blocks, b'')
+            if self.pending:
+                self.compressed.append(self.compressor.compress(self.pending))
+            elif self.compressor is not None:
+                self.compressed.append(self.compressor.flush())
+                self.on_complete(b''.join(self.compressed))
+                self.compressor = None
+                self.compressed = []
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+            self.raw.release_conn()
+        super().close()
+
+
+# The path of a GBIF download status request, or of the listing of a user's
+# downloads, whose responses change while downloads are being prepared.
+DOWNLOAD_STATUS_PATH = re.compile(
+    r'/occurrence/download/(?:user/[^/]+|(?!request\b)[^/]+)$')
+
+class CachingAdapter(requests.adapters.HTTPAdapter):
+    # This adapter records the successful responses it receives in a
+    # ResponseStore and replays them. In 'record' mode every request goes to
+    # the network. In 'replay' mode stored responses are served without one,
+    # or after a conditional request if 'revalidate' is set, and misses are
+    # recorded. Download status requests are always revalidated, since a
+    # stored status would otherwise never change. In 'offline' mode only
+    # stored responses are served. Streamed responses stay streamed: their
+    # body is copied into the store as it is read, by a TeeReader.
+
+    def __init__(self, store, mode, revalidate=False, **kwargs):
+        super().__init__(**kwargs)
+        self.store = store
+        self.mode = mode
+        self.revalidate = revalidate
+
+    def send(self, request, **kwargs):
+        key = request_key(request)
+        cached = None
+        if self.mode in ('replay', 'offline'):
+            cached = self.store.get(key)
+        path = urllib.parse.urlsplit(request.url).path
+        revalidate = (self.revalidate
+                      or bool(DOWNLOAD_STATUS_PATH.search(path)))
+        if cached and (self.mode == 'offline' or not revalidate):
+            return self.replay(request, cached)
+        if self.mode == 'offline':
+            raise requests.ConnectionError('No recorded response for '
+                                           + request.url, request=request)
+        if cached:
+            request = request.copy()
+            headers = requests.structures.CaseInsensitiveDict(cached[2])
+            if 'ETag' in headers:
+                request.headers['If-None-Match'] = headers['ETag']
+            if 'Last-Modified' in headers:
+                request.headers['If-Modified-Since'] = headers['Last-Modified']
+        response = super().send(request, **kwargs)
+        if cached and response.status_code == 304:
+            response.close()
+            return self.replay(request, cached)
+        if 200 <= response.status_code < 300:
+            # The body is stored decoded, so its encoding headers are dropped.
+            headers = {k: v for k, v in response.headers.items() if k.lower()
+                       not in ('content-encoding', 'content-length',
+                               'transfer-encoding')}
+            if kwargs.get('stream'):
+                store = functools.partial(self.store.put_compressed, key,
+                    request.url, response.status_code, response.reason,
+                    headers)
+                raw = urllib3.HTTPResponse(body=TeeReader(response.raw,
+                    store), headers=headers, status=response.status_code,
+                    reason=response.reason, preload_content=False,
+                    decode_content=False)
+                return self.build_response(request, raw)
+            self.store.put(key, request.url, response.status_code,
+                response.reason, headers, response.content)
+            return self.replay(request, (response.status_code,
+                response.reason, headers, response.content))
+        return response
+
+    def replay(self, request, cached):
+        # Builds a response from a stored one, with a body that can be read
+        # or streamed like that of a live response.
+        status, reason, headers, body = cached
+        raw = urllib3.HTTPResponse(body=io.BytesIO(body), headers=headers,
+            status=status, reason=reason, preload_content=False,
+            decode_content=False)
+        return self.build_response(request, raw)
+
+    def close(self):
+        super().close()
+        self.store.close()
+
+
+class BackboneIndex:
+    # This class matches scientific names against a local dump of the GBIF
+    # Backbone Taxonomy (backbone.zip or its Taxon.tsv) instead of the remote
+    # species/match service. Names are indexed by their normalized canonical
+    # name, synonyms are resolved to their accepted taxon and infraspecific
+    # taxa to their species. match() returns the fields of a species/match
+    # response that the pipeline uses.
+
+    columns = ['taxonID', 'parentNameUsageID', 'acceptedNameUsageID',
+               'canonicalName', 'taxonRank', 'taxonomicStatus', 'kingdom',
+               'phylum', 'order', 'family', 'genus']
+    # Rank markers that NCBI names include but canonical names leave out.
+    markers = {'subsp.', 'ssp.', 'var.', 'subvar.', 'f.', 'forma', 'cv.', 'x',
+               '\u00d7'}
+
+    def __init__(self, path, kingdom, chunk_size=1000000):
+        with ExitStack() as stack:
+            if path.endswith('.zip'):
+                archive = stack.enter_context(ZipFile(path))
+                infile = stack.enter_context(archive.open('Taxon.tsv'))
+            else:
+                infile = path
+            reader = pd.read_csv(infile, sep='\t', quoting=csv.QUOTE_NONE,
+                usecols=self.columns, dtype=str, na_filter=False,
+                encoding='utf-8', chunksize=chunk_size)
+            taxa = pd.concat(chunk[chunk['kingdom'].str.lower()
+                                   == kingdom.lower()] for chunk in reader)
+        self.taxa = taxa.set_index('taxonID', drop=False)
+        self.names = {}
+        for taxon_id, name, status in zip(taxa['taxonID'],
+                                          taxa['canonicalName'],
+                                          taxa['taxonomicStatus']):
+            if name:
+                self.names.setdefault(self.normalize(name), []).append(
+                    (status != 'accepted', taxon_id))
+
+    @classmethod
+    def normalize(cls, name):
+        words = name.lower().replace('\u00d7', ' ').split()
+        return ' '.join(w for w in words if w not in cls.markers)
+
+    def accepted(self, taxon_id):
+        # Follows a synonym to its accepted taxon.
+        taxon = self.taxa.loc[taxon_id]
+        if taxon['acceptedNameUsageID'] in self.taxa.index:
+            return self.taxa.loc[taxon['acceptedNameUsageID']]
+        return taxon
+
+    def species(self, taxon):
+        # Follows an infraspecific taxon up to its species.
+        while (taxon['taxonRank'] != 'species'
+               and taxon['parentNameUsageID'] in self.taxa.index):
+            parent = self.taxa.loc[taxon['parentNameUsageID']]
+            if parent['taxonRank'] in ('genus', 'family', 'order'):
+                break
+            taxon = parent
+        return taxon
+
+    def lookup(self, name):
+        # Returns the accepted taxon a normalized name resolves to, or None
+        # if it is unknown or resolves to more than one accepted taxon.
+        candidates = sorted(self.names.get(name, []))
+        if not candidates:
+            return None
+        # Accepted names are preferred over synonyms and doubtful names.
+        best = [taxon_id for synonym, taxon_id in candidates
+                if synonym == candidates[0][0]]
+        accepted = {self.accepted(taxon_id)['taxonID'] for taxon_id in best}
+        if len(accepted) > 1:
+            return None
+        return self.accepted(best[0])
+
+    def match(self, name):
+        # The rank returned is always that of the taxon actually matched, so
+        # that a match that falls back to a genus is dropped by the rank
+        # filter of the pipeline rather than taken for a species.
+        name = self.normalize(name)
+        words = name.split()
+        taxon = self.lookup(name)
+        match_type = 'EXACT'
+        # Informal trailing words, such as 'Japonica Group', are dropped
+        # back to the binomial, and an unknown binomial back to its genus, as
+        # a higher rank match.
+        for size in (2, 1):
+            if taxon is None and len(words) > size:
+                taxon = self.lookup(' '.join(words[:size]))
+                match_type = 'HIGHERRANK'
+        if taxon is None:
+            return {'matchType': 'NONE'}
+        result = {'usageKey': taxon['taxonID'],
+                  'matchType': match_type,
+                  'rank': taxon['taxonRank'].upper(),
+                  'phylum': taxon['phylum'],
+                  'order': taxon['order'],
+                  'family': taxon['family'],
+                  'genus': taxon['genus']
+                  }
+        # As with species/match, a match above the species has no species.
+        species = self.species(taxon)
+        if species['taxonRank'] == 'species' or taxon['taxonRank'] in (
+                'subspecies', 'variety', 'subvariety', 'form', 'subform'):
+            result.update(speciesKey=species['taxonID'],
+                          species=species['canonicalName'])
+        return result
+
+
+class SpeciesStatistics:
+    # This class accumulates the count, mean, standard deviation, minimum and
+    # maximum of each sampled variable for each species in a single pass over
+    # chunks of records, ignoring NaN values, so that memory use grows with
+    # the number of species rather than the number of records. The statistics
+    # of each chunk are merged into the running ones with the pairwise update
+    # of Chan et al., which is numerically stable. If 'quantiles' are given,
+    # they are estimated from a uniform random sample of up to
+    # 'reservoir_size' records kept for each species.
+
+    def __init__(self, quantiles=(), reservoir_size=1000, seed=0):
+        self.quantiles = list(quantiles)
+        self.reservoir_size = reservoir_size
+        self.random = np.random.default_rng(seed)
+        self.col_names = None
+        self.rows = {}
+        self.reservoir = None
+
+    def update(self, chunk):
+        # Adds a DataFrame of species keys and sampled values to the running
+        # statistics.
+        if self.col_names is None:
+            self.col_names = [c for c in chunk.columns if c != 'Species Key']
+            shape = (0, len(self.col_names))
+            self.count = np.zeros(shape)
+            self.mean = np.zeros(shape)
+            self.m2 = np.zeros(shape)
+            self.min = np.full(shape, np.inf)
+            self.max = np.full(shape, -np.inf)
+        # Only the distinct keys of the chunk are looked up, in order of first
+        # appearance, and their rows are spread back to every record.
+        codes, keys = pd.factorize(chunk['Species Key'])
+        key_rows = np.array([self.rows.setdefault(key, len(self.rows))
+                             for key in keys.tolist()], dtype=np.int64)
+        self.grow(len(self.rows))
+        rows = key_rows[codes]
+        samples = chunk[self.col_names].to_numpy(dtype=np.float64)
+        self.merge(rows, samples)
+        if self.quantiles:
+            self.sample_reservoir(rows, samples)
+
+    def grow(self, size):
+        added = size - len(self.count)
+        if added:
+            width = len(self.col_names)
+            self.count = np.vstack([self.count, np.zeros((added, width))])
+            self.mean = np.vstack([self.mean, np.zeros((added, width))])
+            self.m2 = np.vstack([self.m2, np.zeros((added, width))])
+            self.min = np.vstack([self.min, np.full((added, width), np.inf)])
+            self.max = np.vstack([self.max, np.full((added, width), -np.inf)])
+
+    def merge(self, rows, samples):
+        order = np.argsort(rows, kind='stable')
+        rows, samples = rows[order], samples[order]
+        unique, starts, inverse = np.unique(rows, return_index=True,
+                                            return_inverse=True)
+        valid = ~np.isnan(samples)
+        values = np.where(valid, samples, 0)
+        count = np.add.reduceat(valid.astype(np.float64), starts)
+        total = np.add.reduceat(values, starts)
+        mean = np.divide(total, count, out=np.zeros_like(total),
+                         where=count > 0)
+        deviations = np.where(valid, samples - mean[inverse], 0)
+        m2 = np.add.reduceat(deviations ** 2, starts)
+        low = np.minimum.reduceat(np.where(valid, samples, np.inf), starts)
+        high = np.maximum.reduceat(np.where(valid, samples, -np.inf), starts)
+        n_a, n_b = self.count[unique], count
+        n = n_a + n_b
+        delta = mean - self.mean[unique]
+        ratio = np.divide(n_b, n, out=np.zeros_like(n), where=n > 0)
+        self.mean[unique] += delta * ratio
+        self.m2[unique] += m2 + delta ** 2 * n_a * ratio
+        self.count[unique] = n
+        self.min[unique] = np.minimum(self.min[unique], low)
+        self.max[unique] = np.maximum(self.max[unique], high)
+
+    def sample_reservoir(self, rows, samples):
+        # Keeps the records with the smallest random priorities per species,
+        # which is a uniform sample of all the records seen so far.
+        chunk = pd.DataFrame(samples, columns=self.col_names)
+        chunk['row'] = rows
+        chunk['priority'] = self.random.random(len(rows))
+        reservoir = pd.concat([self.reservoir, chunk], ignore_index=True)
+        reservoir = reservoir.sort_values(['row', 'priority'])
+        kept = reservoir.groupby('row').cumcount() < self.reservoir_size
+        self.reservoir = reservoir[kept]
+
+    def index(self):
+        keys = sorted(self.rows)
+        return [self.rows[key] for key in keys], pd.Index(keys,
+            name='Species Key')
+
+    def means(self):
+        # Returns the mean of each variable for each species, ordered by
+        # species key like pandas groupby().mean().
+        rows, index = self.index()
+        mean = np.where(self.count > 0, self.mean, np.nan)
+        return pd.DataFrame(mean[rows], index=index, columns=self.col_names)
+
+    def summary(self):
+        # Returns every statistic of each variable for each species, with
+        # the sample standard deviation as in pandas std().
+        rows, index = self.index()
+        std = np.sqrt(np.divide(self.m2, self.count - 1,
+            out=np.full_like(self.m2, np.nan), where=self.count > 1))
+        statistics = {'count': self.count,
+                      'mean': np.where(self.count > 0, self.mean, np.nan),
+                      'std': std,
+                      'min': np.where(self.count > 0, self.min, np.nan),
+                      'max': np.where(self.count > 0, self.max, np.nan)
+                      }
+        columns = {}
+        for i, col_name in enumerate(self.col_names):
+            for name, values in statistics.items():
+                columns[col_name + ' ' + name] = values[rows, i]
+            if self.quantiles:
+                grouped = self.reservoir.groupby('row')[col_name]
+                for q in self.quantiles:
+                    estimates = grouped.quantile(q).reindex(rows)
+                    columns['{} q{}'.format(col_name, q)] = estimates.to_numpy()
+        return pd.DataFrame(columns, index=index)
+
 
 def generate_query_expression(data):
     # This function generates a JSON query expression that is used in a POST
@@ -46,24 +848,301 @@ def generate_query_expression(data):
     }            
     return expression
 
-def prep_esummary_req(query_key, webenv, retstart, retmax, db, api_key):
+def pack_species_keys(species_keys, max_keys):
+    # This function splits a list of species keys into as few chunks of no
+    # more than 'max_keys' keys as possible, all of about the same size.
+    number_of_chunks = max(1, math.ceil(len(species_keys) / max_keys))
+    size = max(1, math.ceil(len(species_keys) / number_of_chunks))
+    return [species_keys[start:start + size]
+            for start in range(0, len(species_keys), size)]
+
+# Base URLs of the NCBI E-utilities and the GBIF API.
+EUTILS_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+GBIF_URL = 'http://api.gbif.org/v1/'
+
+def prep_esummary_req(query_key, webenv, retstart, retmax, db, api_key,
+                      retmode='json', base_url=EUTILS_URL):
     # This function generates a query string to be sent along with a GET
     # request to the Entrez ESummary utility.    
     payload = {'query_key':query_key,
                'webenv':webenv,
                'version':'2.0',
-               'retmode':'json',
+               'retmode':retmode,
                'retmax':retmax,
                'retstart':retstart,
                'db':db,
                'api_key':api_key
                }
-    url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi'
-    req = requests.Request('GET', url, params=payload)
+    req = requests.Request('GET', base_url + 'esummary.fcgi', params=payload)
     prepped = req.prepare()
     prepped.headers['Accept-Encoding'] = 'identity' # Chunked encoding error fix.
     return prepped
 
+def prep_uilist_req(query_key, webenv, retstart, retmax, db, api_key,
+                    base_url=EUTILS_URL):
+    # This function generates a query string to be sent along with a GET
+    # request to the Entrez EFetch utility for a plain list of UIDs.
+    payload = {'query_key':query_key,
+               'webenv':webenv,
+               'rettype':'uilist',
+               'retmode':'text',
+               'retmax':retmax,
+               'retstart':retstart,
+               'db':db,
+               'api_key':api_key
+               }
+    req = requests.Request('GET', base_url + 'efetch.fcgi', params=payload)
+    return req.prepare()
+
+def prep_elink_req(uids, dbfrom, db, api_key, base_url=EUTILS_URL):
+    # This function generates the body of a POST request to the Entrez ELink
+    # utility. Each UID is sent as a separate 'id' field so that its links are
+    # returned in a LinkSet of their own.
+    payload = [('dbfrom', dbfrom), ('db', db), ('retmode', 'xml'),
+               ('api_key', api_key)]
+    payload += [('id', uid) for uid in uids]
+    req = requests.Request('POST', base_url + 'elink.fcgi', data=payload)
+    prepped = req.prepare()
+    prepped.headers['Accept-Encoding'] = 'identity'
+    return prepped
+
+# Names of ESummary 2.0 fields in XML responses, keyed by their JSON names.
+ESUMMARY_XML_FIELDS = {'taxid':'TaxId', 'scientificname':'ScientificName'}
+
+def parse_esummary(response, fields):
+    # This function returns the UID and the given fields of each document
+    # summary in an ESummary response as a list of dictionaries. XML responses
+    # are parsed incrementally as they are read, and each summary is discarded
+    # once its fields have been taken, so the full response is never held in
+    # memory.
+    if response.status_code != requests.codes.ok:
+        return None
+    if 'json' in response.headers.get('Content-Type', ''):
+        result = response.json()['result']
+        # Skips list of UIDs included in result.
+        return [dict(uid=value['uid'], **{f:value[f] for f in fields})
+                for key, value in result.items() if key != 'uids']
+    response.raw.decode_content = True
+    summaries = []
+    for event, elem in ET.iterparse(response.raw):
+        if elem.tag == 'DocumentSummary':
+            summary = {'uid':elem.get('uid')}
+            for f in fields:
+                summary[f] = elem.findtext(ESUMMARY_XML_FIELDS[f])
+            summaries.append(summary)
+            elem.clear()
+    return summaries
+
+def parse_uilist(response):
+    # This function returns the UIDs listed in an EFetch uilist response.
+    if response.status_code != requests.codes.ok:
+        return None
+    return response.text.split()
+
+def parse_elink(response):
+    # This function returns a (UID, linked UID) pair for each link in an ELink
+    # response, parsing it incrementally as it is read.
+    if response.status_code != requests.codes.ok:
+        return None
+    response.raw.decode_content = True
+    links = []
+    for event, elem in ET.iterparse(response.raw):
+        if elem.tag == 'LinkSet':
+            uid = elem.findtext('IdList/Id')
+            for link in elem.iterfind('LinkSetDb/Link/Id'):
+                links.append((uid, link.text))
+            elem.clear()
+    return links
+
+def prep_species_match_req(name, kingdom, strict, base_url=GBIF_URL):
+    # This function generates a query string to be sent along with a GET
+    # request to the GBIF Species API.
+    payload = {'name':name, 'kingdom':kingdom, 'strict':strict}
+    req = requests.Request('GET', base_url + 'species/match', params=payload)
+    return req.prepare()
+
+def send_concurrently(session, prepped_requests, limiter, max_workers, timeout,
+                      parse=None):
+    # This function sends a sequence of prepared requests from a pool of
+    # threads, keeping up to 'max_workers' of them in flight at once. Each
+    # request takes a token from 'limiter', if one is given, before it is
+    # sent. Responses are yielded in the same order as the requests, so
+    # output built from them is identical to that of a serial loop. If a
+    # 'parse' function is given, each response is streamed into it in the
+    # thread that sent the request and its result is yielded instead. The
+    # session's hooks are applied as they would be to session.request.
+    def send(prepped):
+        if limiter is not None:
+            limiter.acquire()
+        prepped.hooks = requests.sessions.merge_hooks(prepped.hooks,
+                                                      session.hooks)
+        if parse is None:
+            return session.send(prepped, timeout=timeout, stream=False)
+        with session.send(prepped, timeout=timeout, stream=True) as response:
+            return parse(response)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for prepped in prepped_requests:
+            if len(pending) == max_workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(send, prepped))
+        while pending:
+            yield pending.popleft().result()
+
+def filter_dataset(path, member, limit, bounds, columnar, chunk_size,
+                   with_uncertainty, file_format, outfile, duplicates=None,
+                   species_keys=None):
+    # This function filters a zipped GBIF occurrence dataset and writes the
+    # species keys and coordinates of the records that pass to 'outfile',
+    # followed by their coordinate uncertainty if 'with_uncertainty' is set.
+    # The dataset is parsed in chunks by filter_occurrences if 'columnar' is
+    # set and row by row by validate_and_filter otherwise. Parquet output, for
+    # which 'outfile' is a ParquetWriter, and output with the uncertainty are
+    # always parsed in chunks. If 'duplicates' is given, such as a
+    # DuplicateFilter, the records are hashed by its 'key' and only those its
+    # keep() method returns true for are written, which also needs chunks.
+    # So does 'species_keys', a list of the species keys whose records are
+    # kept, if only some are wanted.
+    with ExitStack() as stack:
+        archive = stack.enter_context(ZipFile(path))
+        binary = stack.enter_context(archive.open(member))
+        key, digits = ((duplicates.key, duplicates.digits) if duplicates
+                       else (None, None))
+        filtered = filter_occurrences(binary, limit, bounds, chunk_size, key,
+                                      digits, species_keys)
+        if duplicates is not None:
+            filtered = keep_distinct(filtered, duplicates)
+        if file_format == 'parquet':
+            for species_keys, x, y, coord_uncertainty in filtered:
+                if not with_uncertainty:
+                    coord_uncertainty = None
+                outfile.write_table(occurrence_table(species_keys, x, y,
+                                                     coord_uncertainty))
+            return
+        if (columnar or with_uncertainty or duplicates is not None
+                or species_keys is not None):
+            writer = csv.writer(outfile, lineterminator='\n')
+            for species_keys, x, y, coord_uncertainty in filtered:
+                columns = [species_keys, x.tolist(), y.tolist()]
+                if with_uncertainty:
+                    columns.append(coord_uncertainty.tolist())
+                writer.writerows(zip(*columns))
+            return
+        text = stack.enter_context(io.TextIOWrapper(binary, encoding='utf-8'))
+        reader = csv.reader(text, delimiter='\t', quoting=csv.QUOTE_NONE)
+        next(reader) # Skips header.
+        for row in reader:
+            coord_uncertainty = row[18]
+            x = row[17] #longitude
+            y = row[16] #latitude
+            species_key = row[29]
+            filter_ = validate_and_filter(coord_uncertainty, x, y, limit, bounds)
+            if filter_:
+                data = {'skey':species_key}
+                data.update(filter_)
+                outfile.write('{skey},{x},{y}\n'.format(**data))
+
+def keep_distinct(filtered, duplicates):
+    # This function takes the chunks yielded by filter_occurrences and yields
+    # them without their hashes, keeping only the records that 'duplicates'
+    # has not seen before.
+    for species_keys, x, y, coord_uncertainty, hashes in filtered:
+        keep = duplicates.keep(hashes)
+        yield (species_keys[keep], x[keep], y[keep], coord_uncertainty[keep])
+
+def filter_dataset_to_file(part_path, path, member, *args, dedupe=None,
+                           species_keys=None):
+    # This function runs filter_dataset in a worker process, writing to a part
+    # file whose path is returned. The last two arguments are whether the
+    # coordinate uncertainty is kept and the file format. If 'dedupe' is a
+    # key and number of digits as taken by record_hashes, the hashes of the
+    # records written are saved next to the part file, chunk by chunk, since
+    # duplicates can only be told apart across datasets by the process that
+    # merges them.
+    with ExitStack() as stack:
+        if args[-1] == 'parquet':
+            outfile = stack.enter_context(pq.ParquetWriter(part_path,
+                occurrence_schema(args[-2])))
+        else:
+            outfile = stack.enter_context(open(part_path, 'w',
+                encoding='utf-8'))
+        recorder = None
+        if dedupe:
+            recorder = HashRecorder(*dedupe, stack.enter_context(
+                open(part_hashes_path(part_path), 'wb')))
+        filter_dataset(path, member, *args, outfile, recorder, species_keys)
+    return part_path
+
+def part_hashes_path(part_path):
+    # This function returns the path of the record hashes saved with a part
+    # file by filter_dataset_to_file, as raw unsigned 64-bit integers.
+    return part_path + '-hashes.bin'
+
+def append_part_file(part_path, outfile, file_format, duplicates=None,
+                     chunk_size=100000):
+    # This function appends a part file written by filter_dataset_to_file to
+    # the consolidated output. If 'duplicates' is given, such as a
+    # DuplicateFilter, the hashes saved with the part are read alongside it,
+    # a row group or 'chunk_size' lines at a time, and only the records its
+    # keep() method returns true for are appended.
+    with ExitStack() as stack:
+        if duplicates is not None:
+            hashes_file = stack.enter_context(open(part_hashes_path(part_path),
+                                                   'rb'))
+        if file_format == 'parquet':
+            part = pq.ParquetFile(part_path)
+            for i in range(part.num_row_groups):
+                table = part.read_row_group(i)
+                if duplicates is not None:
+                    hashes = np.fromfile(hashes_file, dtype=np.uint64,
+                                         count=table.num_rows)
+                    table = table.filter(duplicates.keep(hashes))
+                outfile.write_table(table)
+            return
+        part_file = stack.enter_context(open(part_path, 'r', encoding='utf-8'))
+        if duplicates is None:
+            shutil.copyfileobj(part_file, outfile)
+            return
+        while True:
+            lines = list(itertools.islice(part_file, chunk_size))
+            if not lines:
+                break
+            hashes = np.fromfile(hashes_file, dtype=np.uint64,
+                                 count=len(lines))
+            outfile.writelines(line for line, kept
+                               in zip(lines, duplicates.keep(hashes)) if kept)
+
+def write_occurrence_rows(outfile, rows, file_format):
+    # This function writes buffered chunks of species keys and coordinates,
+    # given as a list of (species_keys, x, y) arrays, to an open text file or
+    # Parquet writer.
+    if not rows:
+        return
+    species_keys, x, y = (np.concatenate(column) for column in zip(*rows))
+    if file_format == 'parquet':
+        outfile.write_table(occurrence_table(species_keys, x, y))
+    else:
+        csv.writer(outfile, lineterminator='\n').writerows(
+            zip(species_keys, x.tolist(), y.tolist()))
+
+def write_occurrence_part(part_path, rows, file_format):
+    # This function writes buffered chunks as by write_occurrence_rows to a
+    # part file, to be appended later with append_part_file.
+    with ExitStack() as stack:
+        if file_format == 'parquet':
+            outfile = stack.enter_context(pq.ParquetWriter(part_path,
+                occurrence_schema()))
+        else:
+            outfile = stack.enter_context(open(part_path, 'w',
+                encoding='utf-8'))
+        write_occurrence_rows(outfile, rows, file_format)
+
+def raster_bounds(metadata):
+    # This function returns the bounds of a raster from its metadata.
+    xmin, ymin = metadata['transform'] * (0, metadata['height'])
+    xmax, ymax = metadata['transform'] * (metadata['width'], 0)
+    return {'xmin': xmin, 'xmax': xmax, 'ymin': ymin, 'ymax': ymax}
+
 def validate_and_filter(coord_uncertainty, x, y, limit, bounds):
     # This function validates and filters an occurrence record based on its
     # coordinate uncertainty and whether or not it falls within the bounds of
@@ -81,20 +1160,336 @@ def validate_and_filter(coord_uncertainty, x, y, limit, bounds):
             and bounds['ymin'] < coords['y'] < bounds['ymax']):
             return coords
                 
-def get_download_link(session, url, timeout):
-    # This function checks the status of a GBIF occurrence download request.
+def parse_floats(values, exact=True):
+    # This function converts an array of values read by pandas to floats as
+    # float() would, giving NaN for any value that cannot be parsed. Columns
+    # that pandas has already parsed are used as they are. Text is parsed
+    # with float() when 'exact' is set, and otherwise with pandas, which is
+    # faster but may differ in the last digit. Values that pandas fails to
+    # parse are retried one at a time.
+    if values.dtype != object:
+        return values.astype(np.float64)
+    if exact:
+        try:
+            return values.astype(np.float64)
+        except ValueError:
+            pass
+    floats = pd.to_numeric(values, errors='coerce').astype(np.float64)
+    failed = np.isnan(floats)
+    if exact:
+        try:
+            floats[~failed] = values[~failed].astype(np.float64)
+        except ValueError:
+            failed[:] = True
+    for i in np.flatnonzero(failed):
+        try:
+            floats[i] = float(values[i])
+        except ValueError:
+            floats[i] = np.nan
+    return floats
+
+def filter_occurrences(binary, limit, bounds, chunk_size, key=None,
+                       digits=None, species_keys=None):
+    # This function is a columnar counterpart to validate_and_filter. It reads
+    # a GBIF occurrence dataset in chunks of 'chunk_size' rows, parsing only
+    # the latitude, longitude, coordinate uncertainty and species key columns,
+    # and yields the species keys, coordinates and coordinate uncertainty of
+    # the records that pass as NumPy arrays. Empty and unparseable values are
+    # handled as in validate_and_filter. If 'key' is given, the hashes of the
+    # records by record_hashes are yielded as a fifth array, and the gbifID
+    # column is also parsed if it is needed. If 'species_keys' is given, only
+    # records of those species keys pass.
+    usecols = [16, 17, 18, 29]
+    if key == 'gbif-id':
+        usecols.insert(0, 0)
+    # Coordinates are read as text and parsed by parse_floats, since pandas
+    # reads a chunk of whole numbers as integers, which turns '-0' into 0.0
+    # where float() gives -0.0.
+    dtype = {0:str, 16:str, 17:str, 18:str, 29:str}
+    reader = pd.read_csv(binary, sep='\t', quoting=csv.QUOTE_NONE, header=None,
+        skiprows=1, usecols=usecols, dtype=dtype, na_filter=False,
+        float_precision='round_trip', encoding='utf-8', chunksize=chunk_size)
+    for chunk in reader:
+        coord_uncertainty = chunk[18].to_numpy()
+        coord_uncertainty = np.where(coord_uncertainty == '', '0',
+                                     coord_uncertainty)
+        coord_uncertainty = parse_floats(coord_uncertainty, exact=False)
+        x = parse_floats(chunk[17].to_numpy()) #longitude
+        y = parse_floats(chunk[16].to_numpy()) #latitude
+        # Comparisons with NaN are false, so unparseable records are dropped.
+        mask = ((coord_uncertainty <= limit)
+                & (bounds['xmin'] < x) & (x < bounds['xmax'])
+                & (bounds['ymin'] < y) & (y < bounds['ymax']))
+        if species_keys is not None:
+            mask &= chunk[29].isin(species_keys).to_numpy()
+        filtered = (chunk[29].to_numpy()[mask], x[mask], y[mask],
+                    coord_uncertainty[mask])
+        if key is None:
+            yield filtered
+            continue
+        gbif_ids = chunk[0].to_numpy()[mask] if key == 'gbif-id' else None
+        yield filtered + (record_hashes(key, digits, gbif_ids, *filtered[:3]),)
+
+def record_hashes(key, digits, gbif_ids, species_keys, x, y):
+    # This function returns a 64-bit hash of each occurrence record by 'key'.
+    # With 'gbif-id', records are the same if they have the same gbifID, which
+    # catches a record that is in more than one download. With 'location',
+    # records are the same if they have the same species key and coordinates
+    # rounded to 'digits' decimal places, which also catches duplicate
+    # specimens and records published again under another gbifID.
+    if key == 'gbif-id':
+        return pd.util.hash_array(gbif_ids.astype(object))
+    # Adding zero turns -0.0 into 0.0, which would otherwise hash differently.
+    frame = pd.DataFrame({'species_key': species_keys.astype(object),
+                          'x': np.round(x, digits) + 0.0,
+                          'y': np.round(y, digits) + 0.0})
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy()
+
+
+class HashRecorder:
+    # This class stands in for a DuplicateFilter in a worker process. It keeps
+    # every record and writes their hashes to the open binary file 'outfile',
+    # for the process that merges the parts to filter.
+
+    def __init__(self, key, digits, outfile):
+        self.key = key
+        self.digits = digits
+        self.outfile = outfile
+
+    def keep(self, hashes):
+        hashes.astype(np.uint64).tofile(self.outfile)
+        return np.ones(len(hashes), dtype=bool)
+
+
+class DuplicateFilter:
+    # This class drops repeated occurrence records by their hashes from
+    # record_hashes, keeping the first of each. Records are told apart by
+    # their 64-bit hashes alone, so two different records are taken for
+    # duplicates only if their hashes collide, which is unlikely below
+    # billions of records. A Bloom filter answers most lookups, since most
+    # records are new; only hashes it may have seen are looked up in sorted
+    # runs of the hashes kept so far. The runs
+    # are held in memory until they outgrow their share of 'memory_limit'
+    # bytes, then saved to 'spill_dir' and searched as memory-mapped files.
+    # A quarter of the limit goes to the Bloom filter, which gives about one
+    # false positive in a hundred lookups at one record for every ten bits.
+
+    hash_count = 7
+    merge_runs = 8
+
+    def __init__(self, key, digits, spill_dir, memory_limit):
+        self.key = key
+        self.digits = digits
+        self.spill_dir = spill_dir
+        bloom_bytes = 1 << max(int(memory_limit // 4).bit_length() - 1, 3)
+        self.bloom = np.zeros(bloom_bytes, dtype=np.uint8)
+        self.bloom_mask = np.uint64(bloom_bytes * 8 - 1)
+        self.run_limit = max(memory_limit - bloom_bytes, 8) // 8
+        self.runs = []
+        self.spilled = []
+        self.seen = 0
+        self.dropped = 0
+
+    def bloom_positions(self, hashes):
+        # Double hashing: the i-th position is h1 + i * h2, with h2 odd so
+        # that the positions do not repeat.
+        h1 = hashes & np.uint64(0xffffffff)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        for i in range(self.hash_count):
+            yield (h1 + np.uint64(i) * h2) & self.bloom_mask
+
+    def may_contain(self, hashes):
+        found = np.ones(len(hashes), dtype=bool)
+        for positions in self.bloom_positions(hashes):
+            bits = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+            found &= (self.bloom[positions >> np.uint64(3)] & bits) != 0
+        return found
+
+    def contains(self, hashes):
+        found = np.zeros(len(hashes), dtype=bool)
+        for run in self.spilled + self.runs:
+            i = np.minimum(np.searchsorted(run, hashes), len(run) - 1)
+            found |= run[i] == hashes
+        return found
+
+    def add(self, hashes):
+        # 'hashes' are sorted and distinct. Bits in the same byte are combined
+        # first, since fancy assignment keeps only one write to each byte.
+        for positions in self.bloom_positions(hashes):
+            positions = np.unique(positions)
+            index = positions >> np.uint64(3)
+            bits = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+            starts = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+            self.bloom[index[starts]] |= np.bitwise_or.reduceat(bits, starts)
+        self.runs.append(hashes)
+        if len(self.runs) >= self.merge_runs:
+            self.runs = [np.sort(np.concatenate(self.runs))]
+        if sum(len(run) for run in self.runs) > self.run_limit:
+            run = np.sort(np.concatenate(self.runs))
+            path = os.path.join(self.spill_dir,
+                                'hashes-{}.npy'.format(len(self.spilled)))
+            np.save(path, run)
+            self.spilled.append(np.load(path, mmap_mode='r'))
+            self.runs = []
+
+    def keep(self, hashes):
+        # This method returns a mask of the records to keep: the first record
+        # with each hash, unless the hash was seen in an earlier call.
+        unique, first = np.unique(hashes, return_index=True)
+        new = np.ones(len(unique), dtype=bool)
+        maybe = np.flatnonzero(self.may_contain(unique))
+        if len(maybe):
+            new[maybe[self.contains(unique[maybe])]] = False
+        keep = np.zeros(len(hashes), dtype=bool)
+        keep[first[new]] = True
+        if new.any():
+            self.add(unique[new])
+        self.seen += len(hashes)
+        self.dropped += len(hashes) - int(new.sum())
+        return keep
+
+
+def get_download_status(session, url, timeout):
+    # This function returns the status and download link of a GBIF occurrence
+    # download request, or None for both if the status could not be fetched.
     r = session.get(url, stream=False, timeout=timeout)
     if r.status_code == requests.codes.ok:
         result = r.json()
         status = result['status']
         download_link = result['downloadLink']
-        if status in ['PREPARING', 'RUNNING', 'SUSPENDED']:
-            pass
-        elif status == 'SUCCEEDED':
-            return download_link
+        if status in ['PREPARING', 'RUNNING', 'SUSPENDED', 'SUCCEEDED']:
+            return status, download_link
         else:
             raise Exception('Download Request Failed: ' + status)
+    return None, None
+
+def get_download_link(session, url, timeout):
+    # This function checks the status of a GBIF occurrence download request.
+    status, download_link = get_download_status(session, url, timeout)
+    if status == 'SUCCEEDED':
+        return download_link
+
+def count_running_downloads(session, url, user, timeout):
+    # This function returns the number of the GBIF occurrence downloads of
+    # 'user' that are still being prepared, whichever task or query requested
+    # them, or None if the listing could not be fetched.
+    params = {'status': ['PREPARING', 'RUNNING', 'SUSPENDED'], 'limit': 1}
+    r = session.get(url + 'user/' + user, params=params, stream=False,
+                    timeout=timeout)
+    if r.status_code == requests.codes.ok:
+        return r.json()['count']
+
+def wait_for_download_slot(session, url, user, limit, timeout, interval,
+                           deadline, metrics=None):
+    # This function blocks until fewer than 'limit' of the GBIF occurrence
+    # downloads of 'user' are still being prepared. Downloads are counted
+    # across the whole account, so that queries run side by side keep to
+    # GBIF's limit between them. As in poll_downloads, an exception is raised
+    # if no slot is free 'deadline' seconds after waiting starts, which also
+    # stops a listing that cannot be fetched from blocking forever. Time
+    # spent waiting is added to 'metrics', if given.
+    start = time.monotonic()
+    while True:
+        running = count_running_downloads(session, url, user, timeout)
+        if running is not None and running < limit:
+            return
+        if time.monotonic() + interval - start > deadline:
+            raise Exception('Exceeded deadline while waiting for a download '
+                            'slot for ' + user)
+        time.sleep(interval)
+        if metrics is not None:
+            metrics.add('poll_sleep_seconds', interval)
+
+# Seconds to wait before polling a download request again after it is first
+# seen in each state. A suspended download is unlikely to change soon, while
+# a running one is close to finishing.
+POLL_INTERVALS = {'PREPARING': 15, 'RUNNING': 5, 'SUSPENDED': 60, None: 30}
+
+def poll_downloads(session, url, download_ids, timeout, deadline, max_interval,
+                   metrics=None):
+    # This function watches several GBIF occurrence download requests at once
+    # and yields the ID and link of each one as soon as it succeeds. Each
+    # request is polled again after the interval for its state in
+    # POLL_INTERVALS, which grows by half on every poll that finds it
+    # unchanged, up to 'max_interval'. An exception is raised if any request
+    # is still pending 'deadline' seconds after polling starts. Time spent
+    # waiting is added to 'metrics', if given.
+    start = time.monotonic()
+    # Entries are (next poll time, download ID, last status, interval).
+    pending = [(start, download_id, None, 0) for download_id in download_ids]
+    heapq.heapify(pending)
+    while pending:
+        next_poll, download_id, last_status, interval = heapq.heappop(pending)
+        if next_poll - start > deadline:
+            raise Exception('Exceeded deadline while waiting for download '
+                            + download_id)
+        delay = max(0, next_poll - time.monotonic())
+        time.sleep(delay)
+        if metrics is not None:
+            metrics.add('poll_sleep_seconds', delay)
+        status, download_link = get_download_status(session,
+            url + download_id, timeout)
+        if status == 'SUCCEEDED':
+            yield download_id, download_link
+            continue
+        if status == last_status:
+            interval = min(interval * 1.5, max_interval)
+        else:
+            interval = min(POLL_INTERVALS[status], max_interval)
+        next_poll = time.monotonic() + interval
+        heapq.heappush(pending, (next_poll, download_id, status, interval))
     
+def file_name(url):
+    # This function returns the last component of the path of a URL.
+    return os.path.basename(urllib.parse.urlparse(url).path)
+
+def download_file(session, url, path, timeout, max_attempts=10):
+    # This function streams a file to disk without holding it in memory. If
+    # 'path' already holds part of the file, or the connection drops, the
+    # download is resumed with an HTTP Range request. The size of the file on
+    # disk is checked against the size reported by the server.
+    for attempt in range(max_attempts):
+        headers = {'Accept-Encoding':'identity'}
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        try:
+            with session.get(url, headers=headers, stream=True,
+                             timeout=timeout) as r:
+                if r.status_code == 416:
+                    # The partial file is either complete or unusable.
+                    size = r.headers.get('Content-Range', '').split('/')[-1]
+                    if size == str(offset):
+                        return
+                    os.remove(path)
+                    continue
+                r.raise_for_status()
+                if r.status_code == 206:
+                    mode = 'ab'
+                    size = int(r.headers['Content-Range'].split('/')[-1])
+                else:
+                    # The server ignored the Range header.
+                    mode = 'wb'
+                    size = r.headers.get('Content-Length')
+                    size = int(size) if size is not None else None
+                with open(path, mode) as f:
+                    for block in r.iter_content(chunk_size=1024 * 1024):
+                        f.write(block)
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError):
+            continue
+        if size is None or os.path.getsize(path) == size:
+            return
+    raise Exception('Exceeded max retries while attempting to download ' + url)
+
+def hash_file(path):
+    # This function returns the SHA-256 digest of a file as a hex string.
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
 def copy_stream(stream, target_archive):
     # This function copies the contents of a zipped GBIF occurrence download to
     # a consolidated archive.
@@ -102,4 +1497,422 @@ def copy_stream(stream, target_archive):
         zip_info = source_archive.infolist()[0]
         with source_archive.open(zip_info) as source_file:
             with target_archive.open(zip_info, 'w') as target_file:
-                shutil.copyfileobj(source_file, target_file)
\ No newline at end of file
+                shutil.copyfileobj(source_file, target_file)
+
+def read_occurrence_chunks(infile, chunk_size, with_uncertainty=False):
+    # This function reads a file of species keys and coordinates, and their
+    # coordinate uncertainty if 'with_uncertainty' is set, in chunks of
+    # 'chunk_size' records and yields each chunk as a tuple of NumPy arrays.
+    # Species keys are kept as text so that they are written back unchanged.
+    names = ['Species Key', 'x', 'y']
+    dtype = {'Species Key':str, 'x':np.float64, 'y':np.float64}
+    if with_uncertainty:
+        names.append('Coordinate Uncertainty')
+        dtype['Coordinate Uncertainty'] = np.float64
+    reader = pd.read_csv(infile, header=None, names=names, dtype=dtype,
+        float_precision='round_trip', chunksize=chunk_size)
+    for chunk in reader:
+        yield tuple(chunk[name].to_numpy() for name in names)
+
+def pixel_indices(transform, width, height, x, y):
+    # This function returns the row and column of the raster cell each of the
+    # coordinates 'x' and 'y' falls in, and whether it falls inside the raster.
+    cols, rows = ~transform * (x, y)
+    rows = np.floor(rows).astype(np.int64)
+    cols = np.floor(cols).astype(np.int64)
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    return rows, cols, inside
+
+def shard_indices(transform, width, height, x, y, shard_size):
+    # This function returns the row and column of the square shard of
+    # 'shard_size' by 'shard_size' raster cells that each of the coordinates
+    # 'x' and 'y' falls in. Points outside the raster are put in the nearest
+    # shard, where they are sampled as nodata.
+    rows, cols, inside = pixel_indices(transform, width, height, x, y)
+    shard_rows = np.clip(rows // shard_size, 0, (height - 1) // shard_size)
+    shard_cols = np.clip(cols // shard_size, 0, (width - 1) // shard_size)
+    return shard_rows, shard_cols
+
+def cell_indices(transform, width, height, x, y):
+    # This function returns the flat index of the raster cell each of the
+    # coordinates 'x' and 'y' falls in, or -1 for points outside the raster.
+    rows, cols, inside = pixel_indices(transform, width, height, x, y)
+    return np.where(inside, rows * width + cols, -1)
+
+def sample_unique_cells(sample, cells, x, y):
+    # This function calls 'sample' once for each unique raster cell in 'cells',
+    # at the first point that falls in it, and spreads the sampled values back
+    # to every point.
+    _, first, inverse = np.unique(cells, return_index=True,
+                                  return_inverse=True)
+    return sample(x[first], y[first])[inverse]
+
+class CellThinner:
+    # This class keeps the first record of each species in each raster cell
+    # of a raster 'width' by 'height' cells, across all the chunks passed to
+    # keep(). Each pair of species key and cell is encoded as a single int64,
+    # and the pairs seen so far are held as a sorted array.
+
+    def __init__(self, width, height):
+        # Cells are shifted by one so that points outside the raster, in cell
+        # -1, still encode to distinct values.
+        self.cells = width * height + 1
+        self.seen = np.empty(0, dtype=np.int64)
+
+    def keep(self, species_keys, cells):
+        # Returns the indices of the records to keep, in order.
+        pairs = (species_keys.astype(np.int64) * self.cells
+                 + cells.astype(np.int64) + 1)
+        pairs, first = np.unique(pairs, return_index=True)
+        i = np.searchsorted(self.seen, pairs)
+        new = np.ones(len(pairs), dtype=bool)
+        if len(self.seen):
+            new = self.seen[np.minimum(i, len(self.seen) - 1)] != pairs
+        self.seen = np.insert(self.seen, i[new], pairs[new])
+        return np.sort(first[new])
+
+def sample_raster(dataset, x, y):
+    # This function samples every band of an open raster dataset at the
+    # coordinates 'x' and 'y' and returns an array with one row per point.
+    # Points are grouped by the internal block they fall in, each block is
+    # read once and its values are gathered with fancy indexing. Points that
+    # fall outside the raster are given the nodata value.
+    rows, cols, inside = pixel_indices(dataset.transform, dataset.width,
+                                       dataset.height, x, y)
+    fill = dataset.nodata if dataset.nodata is not None else 0
+    samples = np.full((len(rows), dataset.count), fill, dtype=dataset.dtypes[0])
+    block_height, block_width = dataset.block_shapes[0]
+    blocks_per_row = math.ceil(dataset.width / block_width)
+    block_ids = rows // block_height * blocks_per_row + cols // block_width
+    indices = np.flatnonzero(inside)
+    indices = indices[np.argsort(block_ids[indices], kind='stable')]
+    unique, starts = np.unique(block_ids[indices], return_index=True)
+    for block_id, group in zip(unique, np.split(indices, starts[1:])):
+        row_off = block_id // blocks_per_row * block_height
+        col_off = block_id % blocks_per_row * block_width
+        window = Window(col_off, row_off,
+                        min(block_width, dataset.width - col_off),
+                        min(block_height, dataset.height - row_off))
+        block = dataset.read(window=window)
+        samples[group] = block[:, rows[group] - row_off, cols[group] - col_off].T
+    return samples
+
+# Quantized value used for nodata in scaled climate cubes.
+CUBE_NODATA = np.iinfo(np.int16).min
+
+def band_number(file_name):
+    # This function returns the band number of a raster file, taken from the
+    # last run of digits in its name, e.g. 7 for 'wc2.0_bio_2.5m_07.tif'.
+    match = re.search(r'(\d+)\D*$', os.path.splitext(file_name)[0])
+    if match is None:
+        raise Exception('No band number in raster file name: ' + file_name)
+    return int(match.group(1))
+
+def list_raster_files(raster_dir):
+    # This function returns the paths of the GeoTIFF files in 'raster_dir'
+    # ordered by band number, and checks that the bands are numbered from 1
+    # without gaps or duplicates.
+    file_names = [f for f in os.listdir(raster_dir)
+                  if f.lower().endswith(('.tif', '.tiff'))]
+    file_names.sort(key=band_number)
+    bands = [band_number(f) for f in file_names]
+    if bands != list(range(1, len(bands) + 1)):
+        raise Exception('Raster files are not numbered 1 to {}: {}'.format(
+            len(bands), ', '.join(file_names)))
+    return [os.path.join(raster_dir, f) for f in file_names]
+
+def tile_windows(width, height, tile_size, max_pixels=2 ** 20):
+    # This function splits a raster into windows made up of whole tiles of
+    # 'tile_size' pixels, of no more than about 'max_pixels' pixels each,
+    # so that it can be written one window at a time with bounded memory.
+    tiles_across = max(1, max_pixels // tile_size ** 2)
+    window_width = tiles_across * tile_size
+    return [Window(col_off, row_off,
+                   min(window_width, width - col_off),
+                   min(tile_size, height - row_off))
+            for row_off in range(0, height, tile_size)
+            for col_off in range(0, width, window_width)]
+
+def read_window(path, window):
+    # This function reads a window of the first band of a raster file. Each
+    # call opens its own dataset, so it can be run from several threads.
+    with rasterio.open(path) as source:
+        return source.read(1, window=window)
+
+def row_windows(dataset, max_pixels=2 ** 22):
+    # This function splits an open raster dataset into windows spanning its
+    # full width and a whole number of block rows, of no more than about
+    # 'max_pixels' pixels each, so that it can be copied with bounded memory.
+    block_height = dataset.block_shapes[0][0]
+    height = max(1, max_pixels // dataset.width // block_height) * block_height
+    return [Window(0, row_off, dataset.width,
+                   min(height, dataset.height - row_off))
+            for row_off in range(0, dataset.height, height)]
+
+def climate_cube_info(dataset, scaled):
+    # This function returns the metadata stored alongside a climate cube built
+    # from an open raster dataset. If 'scaled', the cube is stored as int16
+    # and a scale and offset are worked out for each band from its range of
+    # valid values.
+    info = {'transform': dataset.transform,
+            'nodata': dataset.nodata,
+            'width': dataset.width,
+            'height': dataset.height,
+            'count': dataset.count,
+            'dtype': np.int16 if scaled else np.dtype(dataset.dtypes[0]),
+            'scales': None,
+            'offsets': None
+            }
+    if not scaled:
+        return info
+    low = np.full(dataset.count, np.inf)
+    high = np.full(dataset.count, -np.inf)
+    for window in row_windows(dataset):
+        data = dataset.read(window=window, masked=True)
+        low = np.fmin(low, data.min(axis=(1, 2)).filled(np.nan))
+        high = np.fmax(high, data.max(axis=(1, 2)).filled(np.nan))
+    low[np.isnan(low)] = 0
+    high[np.isnan(high)] = 0
+    # Valid values are mapped onto [-32767, 32767].
+    info['scales'] = np.where(high > low, (high - low) / 65534, 1)
+    info['offsets'] = (high + low) / 2
+    return info
+
+def write_cube_window(dataset, cube, window, info):
+    # This function copies a window of every band of an open raster dataset
+    # into the rows of a climate cube it covers, with the bands of each pixel
+    # stored next to each other.
+    rows = slice(window.row_off, window.row_off + window.height)
+    data = dataset.read(window=window)
+    if info['scales'] is not None:
+        missing = data == info['nodata']
+        data = np.where(missing, 0, data)
+        scaled = ((data - info['offsets'][:, None, None])
+                  / info['scales'][:, None, None])
+        data = np.rint(scaled).astype(np.int16)
+        data[missing] = CUBE_NODATA
+    cube[rows] = np.moveaxis(data, 0, -1)
+
+def matches_metadata(info, metadata):
+    # This function checks that a cache built from the stacked raster file has
+    # the same transform and nodata value as the raster 'metadata'.
+    nodata = [info['nodata'], metadata['nodata']]
+    if None in nodata:
+        same_nodata = nodata[0] is nodata[1]
+    else:
+        # The nodata value is read back from the GeoTIFF as a float32.
+        same_nodata = np.array_equal(np.float32(nodata[0]),
+                                     np.float32(nodata[1]), equal_nan=True)
+    return info['transform'].almost_equals(metadata['transform']) and same_nodata
+
+def open_climate_cube(path, info, metadata):
+    # This function memory-maps a climate cube read-only, so that processes
+    # sampling it share the page cache, after checking that it was built from
+    # a raster with the same transform and nodata value as 'metadata'.
+    if not matches_metadata(info, metadata):
+        raise Exception('Climate cube does not match the raster metadata: '
+                        + path)
+    cube = np.load(path, mmap_mode='r')
+    if cube.shape != (info['height'], info['width'], info['count']):
+        raise Exception('Climate cube has an unexpected shape: ' + path)
+    return cube
+
+def sample_climate_cube(cube, info, x, y):
+    # This function samples every band of a climate cube at the coordinates
+    # 'x' and 'y', reading a single contiguous run of values for each point,
+    # and returns an array with one row per point. Points that fall outside
+    # the cube are given the nodata value, as in sample_raster().
+    rows, cols, inside = pixel_indices(info['transform'], info['width'],
+                                       info['height'], x, y)
+    fill = info['nodata'] if info['nodata'] is not None else 0
+    if info['scales'] is None:
+        samples = np.full((len(rows), info['count']), fill, dtype=cube.dtype)
+        samples[inside] = cube[rows[inside], cols[inside]]
+        return samples
+    quantized = np.full((len(rows), info['count']), CUBE_NODATA, np.int16)
+    quantized[inside] = cube[rows[inside], cols[inside]]
+    samples = quantized * info['scales'] + info['offsets']
+    samples[quantized == CUBE_NODATA] = fill
+    return samples
+
+# Metres per degree of latitude, used to size buffers on geographic rasters.
+METRES_PER_DEGREE = 111320
+
+def band_offsets(dataset):
+    # This function returns the mean of the valid values of each band of an
+    # open raster dataset, which is subtracted before the values are summed
+    # so that the summed-area tables do not lose precision.
+    total = np.zeros(dataset.count)
+    count = np.zeros(dataset.count)
+    for window in row_windows(dataset):
+        data = dataset.read(window=window, masked=True)
+        total += data.sum(axis=(1, 2)).filled(0)
+        count += data.count(axis=(1, 2))
+    return np.divide(total, count, out=np.zeros_like(total), where=count > 0)
+
+def summed_area_info(dataset):
+    # This function returns the metadata stored alongside the summed-area
+    # tables built from an open raster dataset.
+    return {'transform': dataset.transform,
+            'nodata': dataset.nodata,
+            'width': dataset.width,
+            'height': dataset.height,
+            'count': dataset.count,
+            'geographic': dataset.crs.is_geographic if dataset.crs else True,
+            'offsets': band_offsets(dataset)
+            }
+
+def write_summed_area_window(dataset, sums, counts, window, info):
+    # This function fills in the rows of the summed-area tables covered by a
+    # full-width window of an open raster dataset. Entry (i, j) of the tables
+    # holds the sum and number of valid values of each band above and to the
+    # left of pixel (i, j), so the first row and column are zero. The rows
+    # above the window must already have been written.
+    data = dataset.read(window=window, masked=True)
+    valid = ~np.ma.getmaskarray(data)
+    values = np.where(valid, data.data - info['offsets'][:, None, None], 0)
+    top = window.row_off
+    bottom = top + window.height
+    window_sums = np.cumsum(np.cumsum(values, axis=1), axis=2)
+    window_counts = np.cumsum(np.cumsum(valid, axis=1, dtype=np.int32), axis=2)
+    sums[top + 1:bottom + 1, 1:] = (np.moveaxis(window_sums, 0, -1)
+                                    + sums[top, 1:])
+    counts[top + 1:bottom + 1, 1:] = (np.moveaxis(window_counts, 0, -1)
+                                      + counts[top, 1:])
+
+def open_summed_area_tables(sums_path, counts_path, info, metadata):
+    # This function memory-maps the summed-area tables read-only after
+    # checking that they were built from a raster matching 'metadata'.
+    if not matches_metadata(info, metadata):
+        raise Exception('Summed-area tables do not match the raster metadata: '
+                        + sums_path)
+    shape = (info['height'] + 1, info['width'] + 1, info['count'])
+    tables = [np.load(path, mmap_mode='r') for path in (sums_path, counts_path)]
+    for path, table in zip((sums_path, counts_path), tables):
+        if table.shape != shape:
+            raise Exception('Summed-area table has an unexpected shape: '
+                            + path)
+    return tables
+
+def buffer_pixels(info, y, radius):
+    # This function returns the number of rows and columns either side of the
+    # pixel of each point that a buffer of 'radius' metres covers. Buffers of
+    # less than half a pixel cover the pixel alone.
+    radius = np.nan_to_num(radius)
+    if info['geographic']:
+        dy = radius / METRES_PER_DEGREE
+        dx = dy / np.maximum(np.cos(np.radians(y)), 1e-6)
+    else:
+        dx = dy = radius
+    half_rows = np.rint(dy / abs(info['transform'].e))
+    half_cols = np.rint(dx / abs(info['transform'].a))
+    return (np.minimum(half_rows, info['height']).astype(np.int64),
+            np.minimum(half_cols, info['width']).astype(np.int64))
+
+def sample_buffered(sums, counts, info, sample, x, y, radius):
+    # This function returns the mean of the valid values of every band in a
+    # square window around each point sized to cover a buffer of 'radius'
+    # metres, with four lookups in the summed-area tables whatever the size
+    # of the window. Points whose buffer covers only their own pixel, or that
+    # fall outside the raster, are sampled with 'sample' instead. Windows
+    # without any valid values are given the nodata value.
+    rows, cols, inside = pixel_indices(info['transform'], info['width'],
+                                       info['height'], x, y)
+    half_rows, half_cols = buffer_pixels(info, y, radius)
+    buffered = inside & ((half_rows > 0) | (half_cols > 0))
+    point = np.flatnonzero(~buffered)
+    point_samples = sample(x[point], y[point])
+    # Window means are returned in the same type as point samples, so that
+    # unbuffered points are written out exactly as before.
+    dtype = np.result_type(point_samples.dtype, np.float32)
+    samples = np.empty((len(x), info['count']), dtype=dtype)
+    samples[point] = point_samples
+    i = np.flatnonzero(buffered)
+    top = np.maximum(rows[i] - half_rows[i], 0)
+    bottom = np.minimum(rows[i] + half_rows[i] + 1, info['height'])
+    left = np.maximum(cols[i] - half_cols[i], 0)
+    right = np.minimum(cols[i] + half_cols[i] + 1, info['width'])
+    total = (sums[bottom, right] - sums[top, right]
+             - sums[bottom, left] + sums[top, left])
+    count = (counts[bottom, right] - counts[top, right]
+             - counts[bottom, left] + counts[top, left])
+    fill = info['nodata'] if info['nodata'] is not None else 0
+    samples[i] = np.divide(total, count, out=np.full(total.shape, np.nan),
+                           where=count > 0) + info['offsets']
+    samples[i] = np.where(count > 0, samples[i], fill)
+    return samples
+
+def require_pyarrow():
+    # This function raises an error if pyarrow, which is needed to read and
+    # write Parquet intermediates, is not installed.
+    if pq is None:
+        raise ImportError('pyarrow is required for Parquet intermediates.')
+
+def occurrence_schema(with_uncertainty=False):
+    # This function returns the schema of a Parquet table of species keys and
+    # coordinates, optionally followed by the coordinate uncertainty.
+    fields = [('Species Key', pa.int64()),
+              ('x', pa.float32()),
+              ('y', pa.float32())
+              ]
+    if with_uncertainty:
+        fields.append(('Coordinate Uncertainty', pa.float32()))
+    return pa.schema(fields)
+
+def occurrence_table(species_keys, x, y, coord_uncertainty=None):
+    # This function builds a typed table of species keys and coordinates.
+    arrays = [pa.array(species_keys.astype(np.int64)),
+              pa.array(x.astype(np.float32)),
+              pa.array(y.astype(np.float32))
+              ]
+    with_uncertainty = coord_uncertainty is not None
+    if with_uncertainty:
+        arrays.append(pa.array(coord_uncertainty.astype(np.float32)))
+    return pa.Table.from_arrays(arrays,
+        schema=occurrence_schema(with_uncertainty))
+
+def read_occurrence_batches(infile, chunk_size, with_uncertainty=False):
+    # This function is the Parquet counterpart to read_occurrence_chunks.
+    parquet_file = pq.ParquetFile(infile)
+    for batch in parquet_file.iter_batches(batch_size=chunk_size):
+        columns = [batch.column(0).to_numpy()]
+        columns += [batch.column(i).to_numpy().astype(np.float64)
+                    for i in range(1, 4 if with_uncertainty else 3)]
+        yield tuple(columns)
+
+def read_climate_chunks(infile, chunk_size, parquet):
+    # This function reads a table of species keys and sampled values in
+    # chunks of 'chunk_size' records and yields each chunk as a DataFrame.
+    if parquet:
+        parquet_file = pq.ParquetFile(infile)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(infile, chunksize=chunk_size)
+
+def climate_schema(col_names):
+    # This function returns the schema of a Parquet table of species keys and
+    # bioclimatic variables.
+    fields = [('Species Key', pa.int64())]
+    fields += [(col_name, pa.float32()) for col_name in col_names]
+    return pa.schema(fields)
+
+def write_climate_samples(writer, species_keys, samples, nodata, parquet):
+    # This function writes the raster values sampled at a chunk of occurrences
+    # with their species keys, either as CSV rows or as a Parquet row group,
+    # with nodata values left empty and the rest rounded to 3 decimals.
+    samples[samples == nodata] = np.nan
+    samples = samples.round(3)
+    if parquet:
+        writer.write_table(climate_table(species_keys, samples, writer.schema))
+    else:
+        cleaned = samples.astype(str)
+        rows = np.column_stack([species_keys, cleaned]).tolist()
+        writer.writerows(rows)
+
+def climate_table(species_keys, samples, schema):
+    # This function builds a typed table of species keys and the raster values
+    # sampled at their occurrences.
+    arrays = [pa.array(species_keys.astype(np.int64))]
+    arrays += [pa.array(column.astype(np.float32)) for column in samples.T]
+    return pa.Table.from_arrays(arrays, schema=schema)